@@ -26,7 +26,7 @@ Comportamento por defeito
   - Se for passado --rewrite-existing, qualquer UID existente será reescrito (atenção: pode ser pesado).
 
 Requisitos
-  pip install requests openpyxl
+  pip install requests openpyxl lxml   (lxml: opcional, mas acelera o openpyxl)
 
 Ficheiros gerados
 - Excel: supplier_invoices.xlsx (configurável no INI)
@@ -39,24 +39,51 @@ Ficheiros gerados
 from __future__ import annotations
 
 import argparse
+import atexit
+import base64
 import configparser
 import datetime as dt
+import functools
+import gzip
+import hashlib
 import html
+import io
 import json
 import logging
+import logging.handlers
+import operator
 import os
+import queue
+import random
 import re
 import socket
+import string
 import sys
+import threading
 import time
-from dataclasses import dataclass
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Sequence
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import requests
 import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from openpyxl import Workbook, load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.writer.excel import ExcelWriter
+
+try:  # optional accelerator: libxml2 parsing + C-level tree traversal
+    from lxml import etree as LET
+except ImportError:  # pragma: no cover - stdlib fallback
+    LET = None
+
+try:  # optional accelerator: faster JSON parsing straight from response bytes
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
 
 from core.efatura_auth import EfaturaAuthManager
 from core.exceptions import EfaturaAuthNeedsReauth
@@ -70,6 +97,9 @@ USERINFO_ENDPOINT = f"{IAM_BASE}/auth/realms/taxpayers/protocol/openid-connect/u
 BAD_RESPONSE_DIR: Optional[Path] = None
 
 NS_DFE = {"d": "urn:cv:efatura:xsd:v1.0"}
+# Clark-notation forms, so hot lookups skip the prefix -> namespace mapping
+_DFE_NS = "{" + NS_DFE["d"] + "}"
+_DFE_LINE_TAG = _DFE_NS + "Line"
 
 
 # Excel schema
@@ -120,10 +150,24 @@ COLUMNS = [
     "Exported",
 ]
 
+# 1-based column number per header name (openpyxl cell coordinates)
+_COL: Dict[str, int] = {name: i + 1 for i, name in enumerate(COLUMNS)}
+
 
 UID_RE = re.compile(r"^[A-Z]{2}\d{10,}$")
 
 
+def _looks_like_uid(t: str) -> bool:
+    """UID_RE.match behind a cheap prefilter: most candidate texts (names, addresses, amounts) fail the first checks."""
+    return (
+        len(t) >= 12
+        and "A" <= t[0] <= "Z"
+        and "A" <= t[1] <= "Z"
+        and t[2].isdigit()
+        and UID_RE.match(t) is not None
+    )
+
+
 
 # =============================================================================
 # Logging utilities
@@ -134,10 +178,27 @@ def now_local_iso() -> str:
 
 
 LOGGER: Optional[logging.Logger] = None
+_LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+
+
+def _stop_log_listener() -> None:
+    """Drain queued records to the real handlers and close them."""
+    global _LOG_LISTENER
+    listener, _LOG_LISTENER = _LOG_LISTENER, None
+    if listener is None:
+        return
+    listener.stop()
+    for h in listener.handlers:
+        h.close()
+
 
 def setup_logging(log_file: Path) -> None:
-    """Configure console + file logging."""
-    global LOGGER
+    """Configure console + file logging.
+
+    log() only enqueues the record; a QueueListener thread does the console/file I/O, so a slow disk
+    never stalls the fetch/parse loop. Pending records are flushed at exit (and on re-setup).
+    """
+    global LOGGER, _LOG_LISTENER
     log_file.parent.mkdir(parents=True, exist_ok=True)
 
     logger = logging.getLogger("update_supplier_invoices")
@@ -147,19 +208,26 @@ def setup_logging(log_file: Path) -> None:
     fmt = logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
     # Reset handlers (re-runs / tests)
+    _stop_log_listener()
     logger.handlers = []
 
     sh = logging.StreamHandler(sys.stdout)
     sh.setFormatter(fmt)
-    logger.addHandler(sh)
 
     fh = logging.FileHandler(str(log_file), encoding="utf-8")
     fh.setFormatter(fmt)
-    logger.addHandler(fh)
+
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    _LOG_LISTENER = logging.handlers.QueueListener(q, sh, fh, respect_handler_level=True)
+    _LOG_LISTENER.start()
 
     LOGGER = logger
 
 
+atexit.register(_stop_log_listener)
+
+
 def log(msg: str) -> None:
     if LOGGER is None:
         ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -183,6 +251,10 @@ def get_text(el: Optional[ET.Element]) -> str:
     """Safe text extraction from an ElementTree node."""
     if el is None:
         return ""
+    if len(el) == 0:
+        # leaf (the common case for DFE fields): no need to walk itertext()
+        txt = el.text
+        return txt.strip() if txt else ""
     try:
         txt = "".join(el.itertext())
     except Exception:
@@ -190,49 +262,51 @@ def get_text(el: Optional[ET.Element]) -> str:
     return (txt or "").strip()
 
 
+# Tag strings are shared by every element of the same name, so a document only has a few dozen
+# distinct ones; memoize the namespace split (bounded, in case of pathological inputs).
+_LOCALNAME_CACHE: Dict[str, str] = {}
+_LN_CACHE: Dict[str, str] = {}
+_LN_CACHE_MAX = 4096
+
+
 def _localname(tag: str) -> str:
     """Return localname of an XML tag, ignoring namespace."""
-    if not tag:
+    if not tag or not isinstance(tag, str):  # lxml: comments/PIs/entities carry a non-str tag
         return ""
-    if "}" in tag:
-        return tag.split("}", 1)[1]
-    return tag
+    ln = _LOCALNAME_CACHE.get(tag)
+    if ln is None:
+        ln = tag.rpartition("}")[2]
+        if len(_LOCALNAME_CACHE) < _LN_CACHE_MAX:
+            _LOCALNAME_CACHE[tag] = ln
+    return ln
 
 
 def _find_first_by_localnames(root: ET.Element, localnames: Sequence[str]) -> Optional[ET.Element]:
     want = {n.lower() for n in localnames}
+    ln = _localname_lower
     for el in root.iter():
-        if _localname(el.tag).lower() in want:
+        if ln(el.tag) in want:
             return el
     return None
 
 
 def _find_all_by_localnames(root: ET.Element, localnames: Sequence[str]) -> List[ET.Element]:
     want = {n.lower() for n in localnames}
-    out: List[ET.Element] = []
-    for el in root.iter():
-        if _localname(el.tag).lower() in want:
-            out.append(el)
-    return out
+    ln = _localname_lower
+    return [el for el in root.iter() if ln(el.tag) in want]
 
 
 def _find_reference_uids(root: ET.Element) -> List[str]:
-    """Heuristic: collect UID-like strings from common reference nodes."""
-    refs: List[str] = []
-    for el in root.iter():
-        ln = _localname(el.tag).lower()
-        if "fiscaldocument" in ln or "reference" in ln or "documentreference" in ln or ln.endswith("document"):
-            txt = (el.text or "").strip()
-            if txt and UID_RE.match(txt):
-                refs.append(txt)
-    # de-dup while preserving order
-    seen = set()
-    out: List[str] = []
-    for r in refs:
-        if r not in seen:
-            seen.add(r)
-            out.append(r)
-    return out
+    """Heuristic: collect UID-like strings from common reference nodes (de-duplicated, in document order)."""
+    def _candidates() -> Iterator[str]:
+        for el in root.iter():
+            ln = _localname_lower(el.tag)
+            if "fiscaldocument" in ln or "reference" in ln or ln.endswith("document"):
+                txt = (el.text or "").strip()
+                if txt and _looks_like_uid(txt):
+                    yield txt
+
+    return list(dict.fromkeys(_candidates()))
 
 
 def _coalesce(*vals: str) -> str:
@@ -247,7 +321,48 @@ def _text_anywhere(root: ET.Element, localnames: Sequence[str]) -> str:
     return get_text(el)
 
 
+# Lower-cased localname per (interned) tag string; the tag vocabulary of DFE documents is small.
+LocalnameIndex = Dict[str, List[Tuple[int, ET.Element]]]
+
+
+def _localname_lower(tag: str) -> str:
+    ln = _LN_CACHE.get(tag) if isinstance(tag, str) else None
+    if ln is None:
+        ln = _localname(tag).lower()
+        if isinstance(tag, str) and len(_LN_CACHE) < _LN_CACHE_MAX:
+            _LN_CACHE[tag] = ln
+    return ln
+
+
+def index_by_localname(root: ET.Element) -> LocalnameIndex:
+    """Bucket root and all its descendants by lower-cased localname, in document order, in one walk.
+
+    Lets a parser answer many field lookups on the same subtree without re-walking it per field.
+    Each entry keeps the document position so "first of several names" keeps document-order semantics.
+    """
+    idx: LocalnameIndex = {}
+    for pos, el in enumerate(root.iter()):
+        idx.setdefault(_localname_lower(el.tag), []).append((pos, el))
+    return idx
+
+
+def _first_indexed(idx: LocalnameIndex, localnames: Sequence[str]) -> Optional[ET.Element]:
+    """Indexed equivalent of _find_first_by_localnames (first match in document order)."""
+    best: Optional[Tuple[int, ET.Element]] = None
+    for name in localnames:
+        hits = idx.get(name.lower())
+        if hits and (best is None or hits[0][0] < best[0]):
+            best = hits[0]
+    return best[1] if best is not None else None
+
+
+def _text_indexed(idx: LocalnameIndex, localnames: Sequence[str]) -> str:
+    return get_text(_first_indexed(idx, localnames))
+
+
 _INVALID_XML_CHARS_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F]")
+# & that does not start an entity (&amp; &#123; &#x1A; &name;)
+_BAD_AMP_RE = re.compile(r"&(?!(?:#\d+|#x[0-9a-fA-F]+|\w+);)")
 
 
 # =============================================================================
@@ -274,26 +389,67 @@ def sanitize_xml_text(s: str) -> str:
     if lt > 0:
         s = s[lt:]
 
-    # Remove illegal chars (except \t \n \r)
-    s = _INVALID_XML_CHARS_RE.sub("", s)
+    # Remove illegal chars (except \t \n \r); search() stops at the first hit, sub() only runs when needed
+    if _INVALID_XML_CHARS_RE.search(s):
+        s = _INVALID_XML_CHARS_RE.sub("", s)
 
     # Escape bare ampersands: & -> &amp; unless already an entity (&amp; &#123; &#x1A; &name;)
-    s = re.sub(r"&(?!(?:#\d+|#x[0-9a-fA-F]+|\w+);)", "&amp;", s)
+    if "&" in s:
+        s = _BAD_AMP_RE.sub("&amp;", s)
 
     return s
 
 
 
 def dump_text(path: Path, text: str) -> None:
+    """Write a forensic dump; a '.gz' suffix writes it gzip-compressed (fast level, XML shrinks ~10x)."""
     path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".gz":
+        with gzip.open(path, "wt", compresslevel=1, encoding="utf-8", errors="replace") as fh:
+            fh.write(text)
+        return
     path.write_text(text, encoding="utf-8", errors="replace")
 
 
 
+def append_dump_record(path: Path, record: Dict[str, Any]) -> None:
+    """Append one JSON line to a per-run '.jsonl.gz' forensic dump.
+
+    Each call adds an independent gzip member (concatenated members are one valid gzip stream, so
+    `zcat` reads the whole file), keeping many dumps in a single file instead of one file each.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if orjson is not None:
+        line = orjson.dumps(record) + b"\n"
+    else:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8", errors="replace")
+    with gzip.open(path, "ab", compresslevel=1) as fh:
+        fh.write(line)
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON from raw bytes (orjson when installed; stdlib json also accepts UTF-8 bytes)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps_bytes(obj: Any) -> bytes:
+    """Serialize to indented UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def payload_digest(text: str) -> bytes:
+    """16-byte BLAKE2b fingerprint of a (trimmed) payload, used to spot the portal serving the same XML twice."""
+    return hashlib.blake2b(text.strip().encode("utf-8", errors="replace"), digest_size=16).digest()
+
+
 def _atomic_write_json(path: Path, obj: dict) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     tmp = path.with_suffix(path.suffix + ".tmp")
-    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.write_bytes(_json_dumps_bytes(obj))
     os.replace(tmp, path)
 
 
@@ -301,16 +457,42 @@ def load_resume_state(path: Path) -> dict:
     if not path.exists():
         return {}
     try:
-        return json.loads(path.read_text(encoding="utf-8"))
+        return _json_loads(path.read_bytes())
     except Exception:
         # If corrupted (e.g., crash during write), ignore and start fresh.
         return {}
 
 
-def save_resume_state(path: Path, state: dict) -> None:
+RESUME_MIN_INTERVAL_SEC = 1.0
+_RESUME_LAST_WRITE: Dict[Path, float] = {}
+# Last state written per path (without "ts"), to skip rewriting identical content
+_RESUME_LAST_STATE: Dict[Path, dict] = {}
+
+
+def save_resume_state(path: Path, state: dict, *, force: bool = False, min_interval: float = RESUME_MIN_INTERVAL_SEC) -> bool:
+    """Write the resume state, debounced to one write per min_interval per path.
+
+    Progress updates in between are coalesced (the next write carries the latest state). Callers pass
+    force=True right after each Excel save and at shutdown, so the file on disk always matches the saved
+    Excel; a crash between saves at worst re-fetches a document that was not saved yet.
+    Only "started" triggers a write from the loop: "completed" is set in memory and rides along with the
+    next write, since it only matters once the rows it refers to are in a saved Excel.
+    Unforced calls whose state equals the last one written are skipped as well.
+    Returns True if the file was written.
+    """
+    now = time.monotonic()
+    last = _RESUME_LAST_WRITE.get(path)
+    if not force and last is not None and now - last < min_interval:
+        return False
     state = dict(state or {})
+    state.pop("ts", None)
+    if not force and _RESUME_LAST_STATE.get(path) == state:
+        return False
+    _RESUME_LAST_STATE[path] = dict(state)
     state["ts"] = now_local_iso()
     _atomic_write_json(path, state)
+    _RESUME_LAST_WRITE[path] = now
+    return True
 
 
 def compute_resume_uid(state: dict) -> Optional[str]:
@@ -323,17 +505,105 @@ def compute_resume_uid(state: dict) -> Optional[str]:
 
 
 
+_LXML_PARSERS = threading.local()
+
+
+def _xml_fromstring(data: bytes, *, recover: bool = False) -> ET.Element:
+    """Parse bytes into an element tree, using lxml when installed (several times faster).
+
+    The lxml tree is API-compatible with what the parsing helpers use (iter/findall/attrib/itertext);
+    comments and processing instructions are dropped so every node carries a real tag, and entities
+    are neither resolved nor fetched from the network. lxml parsers are not shared between threads.
+    recover=True (lxml only) asks libxml2 to repair malformed input instead of failing.
+    """
+    if LET is None:
+        return ET.fromstring(data)
+    mode = "recover" if recover else "strict"
+    parser = getattr(_LXML_PARSERS, mode, None)
+    if parser is None:
+        parser = LET.XMLParser(
+            resolve_entities=False, no_network=True, remove_comments=True, remove_pis=True,
+            recover=recover, huge_tree=recover,
+        )
+        setattr(_LXML_PARSERS, mode, parser)
+    return LET.fromstring(data, parser=parser)
+
+
+_XML_ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&apos;", "'"), ("&amp;", "&"))  # &amp; last
+
+
+def unescape_payload(text: str) -> str:
+    """html.unescape() of the DFE payload, with a fast path for the common case.
+
+    When every '&' starts one of the five XML entities, plain str.replace calls give the same result
+    (each '&' begins at most one entity and &amp; is replaced last, so '&amp;lt;' -> '&lt;').
+    Anything else (numeric refs, HTML named entities, missing ';') goes through html.unescape.
+    """
+    amps = text.count("&")
+    if not amps:
+        return text
+    if amps != sum(text.count(ent) for ent, _ in _XML_ENTITIES):
+        return html.unescape(text)
+    for ent, ch in _XML_ENTITIES:
+        text = text.replace(ent, ch)
+    return text
+
+
+def extract_payload_text(body: bytes) -> Optional[str]:
+    """Text of the first <Payload> below the wrapper root (same match as outer.find(".//Payload")).
+
+    The wrapper is parsed incrementally and parsing stops as soon as that element is complete, so no
+    DOM of the whole response is built. Returns None when there is no such element.
+    """
+    if LET is not None:
+        # libxml2 filters on the tag itself, so Python only sees <Payload> events
+        target = None
+        for event, elem in LET.iterparse(
+            io.BytesIO(body), events=("start", "end"), tag="Payload",
+            resolve_entities=False, no_network=True,
+        ):
+            if event == "start":
+                if target is None and elem.getparent() is not None:
+                    target = elem
+            elif elem is target:
+                return elem.text
+        return None
+
+    root: Optional[ET.Element] = None
+    target = None
+    for event, elem in ET.iterparse(io.BytesIO(body), events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            elif target is None and elem.tag == "Payload":
+                target = elem
+        elif elem is target:
+            return elem.text
+    return None
+
+
 def safe_parse_xml(xml_text: str, *, uid: str, stage: str, dump_dir: Path) -> ET.Element:
     """Parse XML with sanitization + dump on failure."""
     try:
-        return ET.fromstring(xml_text.encode("utf-8", errors="strict"))
+        return _xml_fromstring(xml_text.encode("utf-8", errors="strict"))
     except Exception as e1:
         cleaned = sanitize_xml_text(xml_text)
         try:
-            return ET.fromstring(cleaned.encode("utf-8", errors="strict"))
+            return _xml_fromstring(cleaned.encode("utf-8", errors="strict"))
         except Exception as e2:
+            if LET is not None:
+                # last resort: libxml2 recovery mode; keep a dump since repaired trees may miss content
+                try:
+                    root = _xml_fromstring(cleaned.encode("utf-8", errors="replace"), recover=True)
+                except Exception:
+                    root = None
+                if root is not None:
+                    dump_path = dump_dir / f"{uid}.{stage}.recovered.xml.gz"
+                    dump_text(dump_path, cleaned)
+                    log(f"WARNING: XML for uid={uid} stage={stage} parsed in recovery mode ({e2}); dumped to {dump_path}")
+                    return root
             # dump for later forensic analysis
-            dump_path = dump_dir / f"{uid}.{stage}.xml"
+            dump_path = dump_dir / f"{uid}.{stage}.xml.gz"
             dump_text(dump_path, cleaned)
             raise RuntimeError(f"XML_PARSE_ERROR stage={stage} uid={uid} -> dumped to {dump_path}") from e2
 
@@ -347,27 +617,32 @@ def safe_float(x: Any) -> Optional[float]:
         return None
     if isinstance(x, (int, float)):
         return float(x)
-    s = str(x).strip()
-    if not s:
+    s = x if isinstance(x, str) else str(x)
+    if not s:  # get_text() yields "" for absent fields: the common miss, no float() attempt
         return None
-    s = s.replace(",", ".")
     try:
-        return float(s)
-    except Exception:
+        return float(s)  # float() already ignores surrounding whitespace
+    except ValueError:
+        pass
+    s = s.strip()
+    if not s or "," not in s:
+        return None
+    try:
+        return float(s.replace(",", "."))
+    except ValueError:
         return None
 
 
+@functools.lru_cache(maxsize=4)
 def decode_jwt_exp_unverified(token: str) -> Optional[int]:
     """
     Decode JWT 'exp' claim without verifying signature.
-    Returns exp (unix seconds) or None.
+    Returns exp (unix seconds) or None. Cached: refresh probes keep asking about the same few tokens.
     """
     try:
         parts = token.split(".")
         if len(parts) < 2:
             return None
-        import base64
-
         payload_b64 = parts[1]
         padding = "=" * (-len(payload_b64) % 4)
         payload = base64.urlsafe_b64decode(payload_b64 + padding)
@@ -378,15 +653,45 @@ def decode_jwt_exp_unverified(token: str) -> Optional[int]:
         return None
 
 
+DNS_CACHE_TTL_SEC = 300.0
+_DNS_CACHE: Dict[str, Tuple[float, Tuple[str, ...]]] = {}
+
+
+def _resolve_cached(hostname: str) -> Tuple[str, ...]:
+    """getaddrinfo() is uncached in glibc; keep successful lookups for DNS_CACHE_TTL_SEC (failures are not cached)."""
+    now = time.monotonic()
+    hit = _DNS_CACHE.get(hostname)
+    if hit is not None and now - hit[0] < DNS_CACHE_TTL_SEC:
+        return hit[1]
+    infos = socket.getaddrinfo(hostname, 443, type=socket.SOCK_STREAM)
+    ips = tuple(sorted({info[4][0] for info in infos}))
+    _DNS_CACHE[hostname] = (now, ips)
+    return ips
+
+
 def resolve_or_fail(hostname: str) -> List[str]:
     try:
-        infos = socket.getaddrinfo(hostname, 443, type=socket.SOCK_STREAM)
-        ips = sorted({info[4][0] for info in infos})
-        return ips
+        return list(_resolve_cached(hostname))
     except Exception as e:
         raise RuntimeError(f"DNS resolution failed for {hostname}: {e}") from e
 
 
+# Default checkpoint cadence when the INI does not set save_every_docs. Each save rewrites the whole
+# .xlsx, so saving every few documents dominates long runs; documents not yet saved are simply
+# downloaded again on the next run (they are not in the Excel), and save_every_seconds bounds the loss.
+DEFAULT_SAVE_EVERY_DOCS = 50
+
+# zlib level of the .xlsx ZIP. Intermediate checkpoints are overwritten by the next save, so they
+# use the fastest level (a somewhat larger file); the final save uses zlib's default (6).
+CHECKPOINT_COMPRESS_LEVEL = 1
+FINAL_COMPRESS_LEVEL = 6
+
+# A save rewrites the whole .xlsx, so its cost grows with the workbook. Count-based checkpoints are
+# held back until the time since the last save is at least this many times what that save took,
+# which keeps saving to a bounded share of the run (~1/(1+N)) as the file grows.
+CHECKPOINT_SAVE_COST_FACTOR = 4.0
+
+
 @dataclass
 class Config:
     base_dir: Path
@@ -405,6 +710,7 @@ class Config:
     timeout_sec: int
     retries: int
     backoff_sec: float
+    max_concurrency: int
     progress_every: int
     save_every_docs: int
     save_every_seconds: int
@@ -412,9 +718,29 @@ class Config:
     verbose: bool
 
 
+# Parsed INI per (path, mtime, size, cwd, verbose): the GUI/orchestrator re-runs the export in the same process.
+_CONFIG_CACHE: Dict[Tuple[str, int, int, str, bool], Config] = {}
+
+
 def load_config(path: Path, verbose: bool) -> Config:
+    """Load the INI into a Config; reuses the previous parse while the file is unchanged.
+
+    Every call returns its own Config copy, since callers override fields (paths, checkpoints) in place.
+    """
     if not path.exists():
         raise FileNotFoundError(f"INI not found: {path}")
+    st = path.stat()
+    # relative token paths resolve against the cwd, so it is part of the key
+    key = (str(path.resolve()), st.st_mtime_ns, st.st_size, os.getcwd(), bool(verbose))
+    cached = _CONFIG_CACHE.get(key)
+    if cached is None:
+        cached = _parse_config(path, verbose)
+        _CONFIG_CACHE.clear()
+        _CONFIG_CACHE[key] = cached
+    return replace(cached, auth_scopes=list(cached.auth_scopes))
+
+
+def _parse_config(path: Path, verbose: bool) -> Config:
     cp = configparser.ConfigParser()
     cp.read(path, encoding="utf-8")
 
@@ -459,9 +785,12 @@ def load_config(path: Path, verbose: bool) -> Config:
     timeout_sec = cp.getint("efatura", "timeout_sec", fallback=45)
     retries = cp.getint("efatura", "retries", fallback=3)
     backoff_sec = float(cp.get("efatura", "retry_backoff_sec", fallback="1.5"))
+    max_concurrency = max(1, cp.getint("efatura", "max_concurrency", fallback=1))
 
     progress_every = cp.getint("logging", "progress_every_docs", fallback=10) if "logging" in cp else 10
-    save_every_docs = cp.getint("logging", "save_every_docs", fallback=progress_every) if "logging" in cp else progress_every
+    save_every_docs = (
+        cp.getint("logging", "save_every_docs", fallback=DEFAULT_SAVE_EVERY_DOCS) if "logging" in cp else DEFAULT_SAVE_EVERY_DOCS
+    )
     save_every_seconds = cp.getint("logging", "save_every_seconds", fallback=60) if "logging" in cp else 60
 
     # Optional file logger path (if relative, resolve under base_dir)
@@ -491,6 +820,7 @@ def load_config(path: Path, verbose: bool) -> Config:
         timeout_sec=timeout_sec,
         retries=retries,
         backoff_sec=backoff_sec,
+        max_concurrency=max_concurrency,
         progress_every=progress_every,
         save_every_docs=save_every_docs,
         save_every_seconds=save_every_seconds,
@@ -504,23 +834,112 @@ def load_config(path: Path, verbose: bool) -> Config:
 # eFatura HTTP client
 # =============================================================================
 
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# How much of a 401/403 body is inspected for token-expiry hints (OAuth errors are tiny JSON).
+AUTH_ERROR_PEEK_BYTES = 4096
+# Upper bound for one sleep between _request attempts (before jitter).
+BACKOFF_CAP_SEC = 30.0
+# Reuse a bearer token until this many seconds before its JWT 'exp'.
+TOKEN_REUSE_SKEW_SEC = 300
+
+
+def build_session(retries: int, backoff_sec: float, pool_maxsize: int = 16) -> requests.Session:
+    """Create the HTTP session shared by every eFatura call (listing, XML fetch, userinfo).
+
+    - one pooled HTTPAdapter so TCP+TLS connections are kept alive and reused; a pool per host
+      (services + iam) with pool_maxsize connections each, sized above the fetch concurrency;
+    - transient HTTP statuses (429/5xx) are retried by urllib3 on the same pooled connection,
+      honouring Retry-After. Connection/read errors are left to EfaturaClient._request, which
+      logs them and applies its own backoff.
+    """
+    retry = Retry(
+        total=max(0, int(retries)),
+        connect=0,
+        read=0,
+        status=max(0, int(retries)),
+        backoff_factor=backoff_sec,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, pool_block=False, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "User-Agent": "bwb-export/1.0",
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",
+    })
+    return session
+
+
 class EfaturaClient:
-    def __init__(self, access_token_provider: Callable[[], str], repo_code: str, timeout_sec: int, retries: int, backoff_sec: float, verbose: bool):
+    def __init__(self, access_token_provider: Callable[[], str], repo_code: str, timeout_sec: int, retries: int, backoff_sec: float, verbose: bool, session: Optional[requests.Session] = None, max_concurrency: int = 1, on_token_rejected: Optional[Callable[[], None]] = None):
         self.access_token_provider = access_token_provider
+        # called when the server rejects the token, so the provider drops its own cached copy too
+        self.on_token_rejected = on_token_rejected
         self.repo_code = repo_code
         self.timeout_sec = timeout_sec
         self.retries = retries
         self.backoff_sec = backoff_sec
+        self.backoff_cap = BACKOFF_CAP_SEC
         self.verbose = verbose
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": "bwb-export/1.0"})
+        # workers plus the main thread (reference-document fetches) may each hold a connection
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._owns_session = session is None
+        self.session = session if session is not None else build_session(
+            retries, backoff_sec, pool_maxsize=max(16, int(max_concurrency) + 1)
+        )
+        # The provider may refresh and persist tokens; serialize it when fetching from worker threads.
+        self._token_lock = threading.Lock()
+        # Last token handed out by the provider and the monotonic deadline until which it is reused.
+        self._cached_token: Optional[str] = None
+        self._token_valid_until = 0.0
+        # Accept value -> (token, headers) built for it
+        self._header_cache: Dict[str, Tuple[str, Dict[str, str]]] = {}
+
+    def close(self) -> None:
+        """Close the pooled keep-alive connections (only when the session was created here)."""
+        if self._owns_session:
+            self.session.close()
+
+    def _access_token(self) -> str:
+        """Bearer token, re-asking the provider (token store read, maybe a refresh) only near expiry."""
+        with self._token_lock:
+            if self._cached_token and time.monotonic() < self._token_valid_until:
+                return self._cached_token
+            token = self.access_token_provider()
+            exp = decode_jwt_exp_unverified(token)
+            self._cached_token = token
+            # no readable 'exp': do not cache, keep asking the provider every time
+            self._token_valid_until = (
+                time.monotonic() + (exp - time.time()) - TOKEN_REUSE_SKEW_SEC if exp else 0.0
+            )
+            return token
+
+    def _invalidate_token(self) -> None:
+        with self._token_lock:
+            self._cached_token = None
+            self._token_valid_until = 0.0
+            if self.on_token_rejected is not None:
+                self.on_token_rejected()
 
     def _headers(self, accept: str) -> Dict[str, str]:
-        return {
-            "Authorization": f"Bearer {self.access_token_provider()}",
+        """Request headers for an Accept value; the same dict is reused while the token is unchanged.
+
+        requests merges them into a fresh dict per request, so sharing is safe (callers must not mutate it).
+        """
+        token = self._access_token()
+        cached = self._header_cache.get(accept)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+        headers = {
+            "Authorization": f"Bearer {token}",
             "cv-ef-repository-code": str(self.repo_code),
             "Accept": accept,
         }
+        self._header_cache[accept] = (token, headers)
+        return headers
 
     def _request(self, method: str, url: str, *, headers: Dict[str, str], params: Optional[Dict[str, Any]] = None) -> requests.Response:
         last_exc: Optional[Exception] = None
@@ -532,15 +951,23 @@ class EfaturaClient:
                 if self.verbose:
                     log(f"{method} {url} params={params or {}} (attempt {attempts}/{self.retries})")
                 r = self.session.request(method, url, headers=headers, params=params, timeout=self.timeout_sec)
+                if self.verbose:
+                    # Content-Length is the on-the-wire size; compare with the decoded body to see compression
+                    log(
+                        f"-> HTTP {r.status_code} encoding={r.headers.get('Content-Encoding', 'identity')} "
+                        f"wire={r.headers.get('Content-Length', '?')} decoded={len(r.content or b'')} bytes"
+                    )
                 if r.status_code in (401, 403):
                     # Be explicit: most frequent root cause is expired token
-                    body = (r.text or "").lower()
+                    # only the head of the body is needed; avoid decoding whole error pages
+                    body = (r.content or b"")[:AUTH_ERROR_PEEK_BYTES].decode("utf-8", "ignore").lower()
                     if "expired" in body or "invalid_token" in body or "token" in body:
                         raise PermissionError(f"TOKEN_EXPIRED_OR_INVALID (HTTP {r.status_code})")
                 return r
             except PermissionError:
                 if not retried_auth:
                     retried_auth = True
+                    self._invalidate_token()
                     headers = self._headers(headers.get("Accept", "application/json"))
                     continue
                 raise
@@ -557,12 +984,13 @@ class EfaturaClient:
             except requests.exceptions.SSLError as e:
                 last_exc = e
                 log(f"WARNING: SSL error calling {url} (attempt {attempts}/{self.retries}): {e}")
-            sleep_s = self.backoff_sec * attempts
+            # capped exponential backoff with jitter, so parallel workers do not retry in lockstep
+            sleep_s = min(self.backoff_cap, self.backoff_sec * (2 ** (attempts - 1))) * (0.5 + random.random())
             time.sleep(sleep_s)
         raise RuntimeError(f"Failed to call {url} after {self.retries} attempts: {last_exc}")
 
     def userinfo_taxid(self) -> str:
-        headers = {"Authorization": f"Bearer {self.access_token_provider()}", "Accept": "application/json"}
+        headers = {"Authorization": f"Bearer {self._access_token()}", "Accept": "application/json"}
         r = self._request("GET", USERINFO_ENDPOINT, headers=headers)
         if r.status_code != 200:
             raise RuntimeError(f"userinfo failed HTTP {r.status_code}: {r.text[:300]}")
@@ -583,6 +1011,8 @@ class EfaturaClient:
             - Some eFatura deployments appear to ignore PageSize and/or repeat pages.
               Therefore we stop based on "no new UIDs" and/or repeated page signatures,
               not only on `len(items) < page_size`.
+            - With max_concurrency > 1 the next page is requested (and decoded) in the background
+              while the current one is de-duplicated; it is dropped if the current page is the last.
             """
             page = 1
             records: List[Dict[str, Any]] = []
@@ -590,116 +1020,123 @@ class EfaturaClient:
 
             seen_uids: set[str] = set()
             seen_page_sigs: set[tuple] = set()
+            scanned_keys: set[str] = set()
 
-            def is_last_page(obj: Any) -> Optional[bool]:
-                if not isinstance(obj, dict):
-                    return None
-                for k in ("last", "isLast"):
-                    v = obj.get(k)
-                    if isinstance(v, bool):
-                        return v
-                for k in ("hasNext", "hasMore", "has_next", "has_more"):
-                    v = obj.get(k)
-                    if isinstance(v, bool):
-                        return not v
-                tp = obj.get("totalPages") or obj.get("total_pages") or obj.get("pages")
-                pn = obj.get("page") or obj.get("pageNumber") or obj.get("page_number") or obj.get("number")
-                if isinstance(tp, int) and isinstance(pn, int) and tp > 0:
-                    if pn >= tp or (pn + 1) >= tp:
-                        return True
-                return None
-
-            while True:
-                params = {
-                    "AuthorizedDateStart": date_start.isoformat(),
-                    "AuthorizedDateEnd": date_end.isoformat(),
-                    "PageSize": int(page_size),
-                    "Page": int(page),
-                }
-                log(f"Fetching listing page {page}...")
-                r = self._request("GET", DFE_LIST_ENDPOINT, headers=self._headers("application/json"), params=params)
-                if r.status_code != 200:
-                    raise RuntimeError(f"List DFEs failed HTTP {r.status_code}: {r.text[:500]}")
-                try:
-                    obj = r.json()
-                except Exception:
-                    raise RuntimeError(f"List DFEs did not return JSON. content-type={r.headers.get('content-type')}")
+            if show_fields:
+                self._log_list_fields(self._fetch_list_page(date_start, date_end, page_size, page))
+                return [], []
 
-                if show_fields:
-                    log("=== LIST RESPONSE TOP-LEVEL KEYS ===")
-                    if isinstance(obj, dict):
-                        log(", ".join(sorted(obj.keys())))
-                    else:
-                        log(f"type={type(obj)} (not dict)")
-                    first_item = None
-                    if isinstance(obj, list) and obj:
-                        first_item = obj[0]
-                    elif isinstance(obj, dict):
-                        for v in obj.values():
-                            if isinstance(v, list) and v and isinstance(v[0], dict):
-                                first_item = v[0]
-                                break
-                    if isinstance(first_item, dict):
-                        log("=== FIRST ITEM KEYS ===")
-                        log(", ".join(sorted(first_item.keys())))
+            # at most one listing page in flight ahead of the one being processed
+            executor: Optional[ThreadPoolExecutor] = None
+            if self.max_concurrency > 1:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dfe-list")
+            next_page: Optional[Future] = None
+            try:
+                while True:
+                    if next_page is not None:
+                        obj = next_page.result()
+                        next_page = None
                     else:
-                        log("No first item found to inspect.")
-                    return [], []
+                        obj = self._fetch_list_page(date_start, date_end, page_size, page)
 
-                items = extract_items(obj)
-                if not items:
-                    log(f"Page {page}: 0 items (stop).")
-                    break
+                    items = extract_items(obj)
+                    last_hint = _is_last_page(obj)
+                    if executor is not None and len(items) >= int(page_size) and last_hint is not True and page < 10000:
+                        next_page = executor.submit(self._fetch_list_page, date_start, date_end, page_size, page + 1)
 
-                page_uids: List[str] = []
-                for it in items:
-                    uid = extract_uid_from_item(it)
-                    if uid:
-                        page_uids.append(uid)
-                if page_uids:
-                    sig = (page_uids[0], page_uids[-1], len(page_uids))
-                else:
-                    sig = (str(items[0])[:200], len(items))
-                if sig in seen_page_sigs:
-                    log(f"Page {page}: repeated page signature (stop; pagination loop suspected). sig={sig}")
-                    break
-                seen_page_sigs.add(sig)
-
-                for it in items:
-                    for k in it.keys():
-                        lk = k.lower()
-                        if "authorizeddate" in lk or "register" in lk or "created" in lk or "submitted" in lk or "authorization" in lk:
-                            if k not in discovered_date_keys:
-                                discovered_date_keys.append(k)
-
-                new_items: List[Dict[str, Any]] = []
-                for it in items:
-                    uid = extract_uid_from_item(it)
-                    if uid:
-                        if uid in seen_uids:
-                            continue
-                        seen_uids.add(uid)
-                    new_items.append(it)
-
-                if not new_items:
-                    log(f"Page {page}: 0 new items after de-dup (stop; pagination loop suspected).")
-                    break
+                    if not items:
+                        log(f"Page {page}: 0 items (stop).")
+                        break
 
-                records.extend(new_items)
-                log(f"Page {page}: received {len(items)} items, new {len(new_items)} (total unique-ish so far {len(records)}).")
+                    # extract each item's UID once; reused for the page signature and the de-dup below
+                    item_uids = [extract_uid_from_item(it) for it in items]
+                    page_uids = [u for u in item_uids if u]
+                    if page_uids:
+                        sig = (page_uids[0], page_uids[-1], len(page_uids))
+                    else:
+                        sig = (str(items[0])[:200], len(items))
+                    if sig in seen_page_sigs:
+                        log(f"Page {page}: repeated page signature (stop; pagination loop suspected). sig={sig}")
+                        break
+                    seen_page_sigs.add(sig)
+
+                    # one pass: date-field discovery + cross-page de-dup
+                    new_items: List[Dict[str, Any]] = []
+                    for it, uid in zip(items, item_uids):
+                        # listing items share one schema: only look at keys not classified before
+                        if not scanned_keys.issuperset(it):
+                            _scan_date_keys(it, discovered_date_keys, scanned_keys)
+                        if uid:
+                            if uid in seen_uids:
+                                continue
+                            seen_uids.add(uid)
+                        new_items.append(it)
+
+                    if not new_items:
+                        log(f"Page {page}: 0 new items after de-dup (stop; pagination loop suspected).")
+                        break
 
-                last_hint = is_last_page(obj)
-                if last_hint is True:
-                    break
-                if len(items) < int(page_size):
-                    break
+                    records.extend(new_items)
+                    log(f"Page {page}: received {len(items)} items, new {len(new_items)} (total unique-ish so far {len(records)}).")
 
-                page += 1
-                if page > 10000:
-                    raise RuntimeError("Aborting: too many pages (possible pagination loop).")
+                    if last_hint is True:
+                        break
+                    if len(items) < int(page_size):
+                        break
+
+                    page += 1
+                    if page > 10000:
+                        raise RuntimeError("Aborting: too many pages (possible pagination loop).")
+            finally:
+                if executor is not None:
+                    # a speculative request for a page past the stop point is waited for and dropped
+                    executor.shutdown(wait=True)
 
             return records, discovered_date_keys
 
+    def _fetch_list_page(self, date_start: dt.date, date_end: dt.date, page_size: int, page: int) -> Any:
+        """GET one listing page and return its decoded JSON."""
+        params = {
+            "AuthorizedDateStart": date_start.isoformat(),
+            "AuthorizedDateEnd": date_end.isoformat(),
+            "PageSize": int(page_size),
+            "Page": int(page),
+        }
+        log(f"Fetching listing page {page}...")
+        r = self._request("GET", DFE_LIST_ENDPOINT, headers=self._headers("application/json"), params=params)
+        if r.status_code != 200:
+            raise RuntimeError(f"List DFEs failed HTTP {r.status_code}: {r.text[:500]}")
+        try:
+            try:
+                return _json_loads(r.content)
+            except ValueError:
+                # non-UTF-8 body: let requests decode it with the declared/detected charset
+                return r.json()
+        except Exception:
+            raise RuntimeError(f"List DFEs did not return JSON. content-type={r.headers.get('content-type')}")
+
+    @staticmethod
+    def _log_list_fields(obj: Any) -> None:
+        """--show-fields: log the top-level keys of a listing response and of its first item."""
+        log("=== LIST RESPONSE TOP-LEVEL KEYS ===")
+        if isinstance(obj, dict):
+            log(", ".join(sorted(obj.keys())))
+        else:
+            log(f"type={type(obj)} (not dict)")
+        first_item = None
+        if isinstance(obj, list) and obj:
+            first_item = obj[0]
+        elif isinstance(obj, dict):
+            for v in obj.values():
+                if isinstance(v, list) and v and isinstance(v[0], dict):
+                    first_item = v[0]
+                    break
+        if isinstance(first_item, dict):
+            log("=== FIRST ITEM KEYS ===")
+            log(", ".join(sorted(first_item.keys())))
+        else:
+            log("No first item found to inspect.")
+
     def fetch_dfe_inner_xml(self, uid: str) -> str:
         url = DFE_XML_ENDPOINT_TMPL.format(uid=uid)
         r = self._request("GET", url, headers=self._headers("application/xml"))
@@ -717,15 +1154,14 @@ class EfaturaClient:
             self._dump_http_response(uid, r, stage="unexpected_content_type", note=f"Content-Type={ct}")
             raise RuntimeError(f"Unexpected response type for uid={uid} Content-Type={ct}")
 
-        # Parse wrapper XML
+        # Parse wrapper XML (only up to the <Payload> element)
         try:
-            outer = ET.fromstring(body_bytes)
+            payload_text = extract_payload_text(body_bytes)
         except Exception as e:
             self._dump_http_response(uid, r, stage="outer_xml_parse_error", note=str(e))
             raise
 
-        payload = outer.find(".//Payload")
-        if payload is None or not (payload.text or "").strip():
+        if not (payload_text or "").strip():
             # sometimes API could return raw xml
             txt = r.text or ""
             if "<Dfe" in txt:
@@ -733,7 +1169,7 @@ class EfaturaClient:
             self._dump_http_response(uid, r, stage="no_payload", note="No <Payload> element or empty payload")
             raise RuntimeError("No Payload in DFE XML response wrapper.")
 
-        inner = html.unescape(payload.text)
+        inner = unescape_payload(payload_text)
         return inner
 
     def _dump_http_response(self, uid: str, r: requests.Response, *, stage: str, note: str) -> None:
@@ -749,6 +1185,7 @@ class EfaturaClient:
                 f"status={r.status_code}",
                 f"reason={getattr(r, 'reason', '')}",
                 f"note={note}",
+                f"decoded_body_bytes={len(r.content or b'')}",
                 "headers:",
             ]
             for k, v in (r.headers or {}).items():
@@ -758,7 +1195,7 @@ class EfaturaClient:
             # raw body
             (base.with_suffix(".body.bin")).write_bytes(r.content or b"")
             # best-effort text preview
-            preview = (r.text or "")[:5000]
+            preview = (r.content or b"")[:5000].decode("utf-8", "replace")
             dump_text(base.with_suffix(".body.txt"), preview)
 
             log(f"DEBUG: dumped HTTP response for uid={uid} stage={stage} -> {base}.*")
@@ -767,6 +1204,133 @@ class EfaturaClient:
 
 
 
+class DfePrefetcher:
+    """Fetch DFE XMLs ahead of the consumer with a bounded thread pool.
+
+    Downloads of independent UIDs overlap, while the caller still consumes them one by one in its own
+    order, so Excel writes and resume checkpoints stay single-threaded and sequential.
+    With max_workers <= 1 every get_parsed() is a plain synchronous fetch (no threads).
+
+    An optional parse(uid, xml) callable runs in the worker right after the download (it must not
+    touch shared state such as the workbook); get_parsed() returns its result, or the exception it
+    raised, alongside the XML so the caller decides when to surface it.
+
+    Each payload's payload_digest() is computed in the worker as well. When it is already in
+    seen_digests (the caller's digest -> first UID map, only written by the caller) the parse is
+    skipped: the caller will drop that UID as a repeated payload anyway.
+    """
+
+    def __init__(
+        self,
+        client: EfaturaClient,
+        uids: Sequence[str],
+        max_workers: int,
+        parse: Optional[Callable[[str, str], Any]] = None,
+        seen_digests: Optional[Dict[bytes, str]] = None,
+    ):
+        self.client = client
+        self._seen_digests = seen_digests
+        self._uids = list(uids)
+        self._next = 0
+        self._window = max(1, int(max_workers))
+        self._parse = parse
+        self._pending: Dict[str, Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if self._window > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self._window, thread_name_prefix="dfe-fetch")
+
+    def _fetch(self, uid: str) -> Tuple[str, bytes, Any, Optional[Exception]]:
+        xml = self.client.fetch_dfe_inner_xml(uid)
+        digest = payload_digest(xml)
+        if self._parse is None:
+            return xml, digest, None, None
+        seen = self._seen_digests
+        if seen is not None and seen.get(digest, uid) != uid:
+            # repeated payload: not parsed
+            return xml, digest, None, None
+        try:
+            return xml, digest, self._parse(uid, xml), None
+        except Exception as e:
+            return xml, digest, None, e
+
+    def _fill(self) -> None:
+        assert self._executor is not None
+        while self._next < len(self._uids) and len(self._pending) < self._window:
+            uid = self._uids[self._next]
+            self._next += 1
+            self._pending[uid] = self._executor.submit(self._fetch, uid)
+
+    def get_parsed(self, uid: str) -> Tuple[str, bytes, Any, Optional[Exception]]:
+        """Return (inner XML, payload digest, parse result, parse exception) for uid (re-raises the fetch exception, if any)."""
+        if self._executor is None:
+            return self._fetch(uid)
+        self._fill()
+        fut = self._pending.pop(uid, None)
+        if fut is None:
+            # not part of the planned sequence (or beyond the window): fetch synchronously
+            return self._fetch(uid)
+        try:
+            return fut.result()
+        finally:
+            self._fill()
+
+    def close(self) -> None:
+        """Cancel fetches not yet started and wait for in-flight ones."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            self._pending.clear()
+
+
+# Pagination hints seen across listing response shapes (first truthy key wins, as with chained `or`).
+_LAST_BOOL_KEYS = ("last", "isLast")
+_HAS_MORE_KEYS = ("hasNext", "hasMore", "has_next", "has_more")
+_TOTAL_PAGES_KEYS = ("totalPages", "total_pages", "pages")
+_PAGE_NUM_KEYS = ("page", "pageNumber", "page_number", "number")
+
+
+def _first_truthy(obj: Dict[str, Any], keys: Sequence[str]) -> Any:
+    for k in keys:
+        v = obj.get(k)
+        if v:
+            return v
+    return None
+
+
+def _is_last_page(obj: Any) -> Optional[bool]:
+    """True/False when the listing page says whether it is the last one; None when it gives no hint."""
+    if not isinstance(obj, dict):
+        return None
+    for k in _LAST_BOOL_KEYS:
+        v = obj.get(k)
+        if isinstance(v, bool):
+            return v
+    for k in _HAS_MORE_KEYS:
+        v = obj.get(k)
+        if isinstance(v, bool):
+            return not v
+    tp = _first_truthy(obj, _TOTAL_PAGES_KEYS)
+    pn = _first_truthy(obj, _PAGE_NUM_KEYS)
+    if isinstance(tp, int) and isinstance(pn, int) and tp > 0:
+        if pn >= tp or (pn + 1) >= tp:
+            return True
+    return None
+
+
+_DATE_KEY_SUBSTRINGS = ("authorizeddate", "register", "created", "submitted", "authorization")
+
+
+def _scan_date_keys(item: Dict[str, Any], out: List[str], seen: set) -> None:
+    """Append to out (in first-seen order) the keys of item that look like date fields; mark all keys as seen."""
+    for k in item:
+        if k in seen:
+            continue
+        seen.add(k)
+        lk = k.lower()
+        if any(sub in lk for sub in _DATE_KEY_SUBSTRINGS):
+            out.append(k)
+
+
 def extract_items(obj: Any) -> List[Dict[str, Any]]:
     """
     Attempt to normalize different possible list response shapes.
@@ -788,19 +1352,24 @@ def extract_items(obj: Any) -> List[Dict[str, Any]]:
     return []
 
 
+_UID_CANDIDATE_KEYS = (
+    "Id", "ID", "Uid", "UID", "Iud", "IUD", "DfeId", "dfeId", "DocumentId", "documentId", "DocumentUid", "documentUid",
+)
+
+
 def extract_uid_from_item(item: Dict[str, Any]) -> Optional[str]:
-    candidates = [
-        "Id", "ID", "Uid", "UID", "Iud", "IUD", "DfeId", "dfeId", "DocumentId", "documentId", "DocumentUid", "documentUid"
-    ]
-    for k in candidates:
+    for k in _UID_CANDIDATE_KEYS:
         v = item.get(k)
-        if isinstance(v, str) and UID_RE.match(v.strip()):
-            return v.strip()
-    # fallback: search any string field that looks like UID
+        if v is None or type(v) is not str:
+            continue
+        s = v.strip()
+        if _looks_like_uid(s):
+            return s
+    # fallback: search any string field that looks like UID (the prefilter keeps this cheap)
     for v in item.values():
         if isinstance(v, str):
             s = v.strip()
-            if UID_RE.match(s):
+            if _looks_like_uid(s):
                 return s
     return None
 
@@ -871,15 +1440,21 @@ DOC_ELEMENT_TO_PREFIX = {v["element"]: v["prefix"] for v in DTC_TO_META.values()
 DTC_TO_ELEMENT = {k: v["element"] for k, v in DTC_TO_META.items()}
 
 
+_ASCII_LETTERS = frozenset(string.ascii_letters)
+
+
 def infer_tipo_documento(document_number: str, doc_kind: str = "") -> str:
     """Infer 'Tipo de Documento' using DocumentNumber prefix and/or doc_kind (best-effort)."""
     num = (document_number or "").strip()
     if num:
-        m = re.match(r"^\s*([A-Za-z]{1,4})\b", num)
-        if m:
-            pref = m.group(1).upper()
-            if pref in DOC_PREFIX_TO_TIPO:
-                return DOC_PREFIX_TO_TIPO[pref]
+        # same rule as ^([A-Za-z]{1,4})\b, without the regex engine: 1-4 ASCII letters, then a non-word char or end
+        i = 0
+        while i < 4 and i < len(num) and num[i] in _ASCII_LETTERS:
+            i += 1
+        if i and (i == len(num) or not (num[i].isalnum() or num[i] == "_")):
+            tipo = DOC_PREFIX_TO_TIPO.get(num[:i].upper())
+            if tipo:
+                return tipo
     kind = (doc_kind or "").strip().lower()
     if kind == "invoice":
         return "Factura"
@@ -889,37 +1464,72 @@ def infer_tipo_documento(document_number: str, doc_kind: str = "") -> str:
         return doc_kind
     return ""
 
-def safe_save_workbook(wb: Workbook, path: Path) -> None:
-    """Write to temp then replace for improved crash safety."""
+def safe_save_workbook(wb: Workbook, path: Path, *, compress_level: int = FINAL_COMPRESS_LEVEL) -> None:
+    """Write to temp then replace for improved crash safety.
+
+    The export keeps a normal (read/write) workbook on purpose: it is re-saved at every checkpoint and
+    rows of rewritten UIDs are purged in place, while openpyxl write-only workbooks can be saved only
+    once and do not allow edits. Rows are still added with ws.append() (see append_line_rows).
+
+    Same steps as openpyxl's save_workbook(), except that the zlib level of the .xlsx ZIP is chosen
+    by the caller (CHECKPOINT_COMPRESS_LEVEL for intermediate checkpoints).
+    """
     tmp = path.with_suffix(path.suffix + ".tmp")
-    wb.save(tmp)
+    wb.properties.modified = dt.datetime.now(tz=dt.timezone.utc).replace(tzinfo=None)
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=compress_level) as archive:
+        ExcelWriter(wb, archive).save()
     os.replace(tmp, path)
 
 
 
-def delete_uid_rows(ws: Worksheet, uid: str) -> int:
-    """Delete all Excel rows (excluding header) for a given UID. Returns number of deleted rows."""
-    uid = (uid or "").strip()
-    if not uid:
-        return 0
-    deleted = 0
-    # delete bottom-up to avoid index shift issues
-    for r in range(ws.max_row, 1, -1):
-        v = ws.cell(row=r, column=1).value
-        if isinstance(v, str) and v.strip() == uid:
-            ws.delete_rows(r, 1)
-            deleted += 1
-    return deleted
+def purge_rows(ws: Worksheet, rows: Iterable[int]) -> int:
+    """Delete the given rows (1-based, header excluded) in a single bottom-up pass.
+
+    Used to drop rows superseded by a UID rewrite: instead of deleting rows as each UID is rewritten
+    (every delete_rows() shifts all rows below it), old rows are tombstoned and purged together just
+    before the workbook is saved. Contiguous rows are removed with one delete_rows() call.
+    Returns number of deleted rows.
+    """
+    targets = sorted({r for r in rows if r > 1}, reverse=True)
+    i = 0
+    while i < len(targets):
+        end = targets[i]
+        start = end
+        i += 1
+        while i < len(targets) and targets[i] == start - 1:
+            start = targets[i]
+            i += 1
+        ws.delete_rows(start, end - start + 1)
+    return len(targets)
+
+
+def last_row(ws: Worksheet) -> int:
+    """Index of the last row written so far (the row after which ws.append() writes next).
+
+    openpyxl keeps this cursor up to date on append/delete_rows; ws.max_row would instead
+    recompute it from every cell of the sheet, which is O(cells) per call.
+    """
+    cur = getattr(ws, "_current_row", None)
+    return cur if isinstance(cur, int) and cur > 0 else ws.max_row
+
+
+def index_uid_rows(ws: Worksheet) -> Dict[str, List[int]]:
+    """Map UID -> list of row indices holding that UID (header excluded).
+
+    Reads only column A, in one pass; the keys double as the in-memory set of UIDs already exported.
+    """
+    uid_map: Dict[str, List[int]] = {}
+    for r, (uid,) in enumerate(ws.iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+        if isinstance(uid, str):
+            uid = uid.strip()
+            if uid:
+                uid_map.setdefault(uid, []).append(r)
+    return uid_map
 
 
 def _read_header(ws: Worksheet) -> List[str]:
-    vals = [ws.cell(row=1, column=c).value for c in range(1, ws.max_column + 1)]
-    out: List[str] = []
-    for v in vals:
-        if v is None:
-            out.append("")
-        else:
-            out.append(str(v).strip())
+    row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    out = ["" if v is None else str(v).strip() for v in row]
     # trim trailing empty
     while out and out[-1] == "":
         out.pop()
@@ -942,13 +1552,18 @@ def ensure_workbook(path: Path) -> Tuple[Workbook, Worksheet, Dict[str, List[int
     uid_map: Dict[str, List[int]] = {}
 
     if path.exists():
+        # Single editable load, header read from it: a read-only pre-check would open the file twice
+        # and relies on the sheet's <dimension> tag, which can be stale and truncate row 1.
         wb = load_workbook(path)
         ws = wb.active
 
         header = _read_header(ws)
-        if header == COLUMNS:
-            pass
-        elif header == COLUMNS_V1:
+        if header != COLUMNS and header != COLUMNS_V1:
+            raise RuntimeError(
+                f"Excel header mismatch in {path}. Expected columns: {COLUMNS} (or legacy {COLUMNS_V1}), got: {header}"
+            )
+
+        if header == COLUMNS_V1:
             log(f"Excel header v1 detected in {path}; migrating to v2 (adding 'Tipo de Documento').")
             insert_at = header.index("Numero Documento") + 1  # 1-based, insert BEFORE Numero Documento
             ws.insert_cols(insert_at)
@@ -959,40 +1574,49 @@ def ensure_workbook(path: Path) -> Tuple[Workbook, Worksheet, Dict[str, List[int
                 ws.cell(row=1, column=c, value=name)
 
             # best-effort backfill
-            col_docnum = COLUMNS.index("Numero Documento") + 1
-            col_tipo = COLUMNS.index("Tipo de Documento") + 1
-            for r in range(2, ws.max_row + 1):
-                cur = ws.cell(row=r, column=col_tipo).value
+            col_docnum = _COL["Numero Documento"]
+            col_tipo = _COL["Tipo de Documento"]
+            lo, hi = min(col_tipo, col_docnum), max(col_tipo, col_docnum)
+            for cells in ws.iter_rows(min_row=2, min_col=lo, max_col=hi):
+                tipo_cell = cells[col_tipo - lo]
+                cur = tipo_cell.value
                 if cur is None or str(cur).strip() == "":
-                    docnum = ws.cell(row=r, column=col_docnum).value
+                    docnum = cells[col_docnum - lo].value
                     tipo = infer_tipo_documento(str(docnum) if docnum is not None else "")
                     if tipo:
-                        ws.cell(row=r, column=col_tipo, value=tipo)
+                        tipo_cell.value = tipo
 
             safe_save_workbook(wb, path)
             log("Excel migration saved.")
-        else:
-            raise RuntimeError(
-                f"Excel header mismatch in {path}. Expected columns: {COLUMNS} (or legacy {COLUMNS_V1}), got: {header}"
-            )
 
-        for r in range(2, ws.max_row + 1):
-            uid = ws.cell(row=r, column=1).value
-            if isinstance(uid, str) and uid.strip():
-                uid_map.setdefault(uid.strip(), []).append(r)
-        return wb, ws, uid_map
+        return wb, ws, index_uid_rows(ws)
 
     # create new workbook
+    # Not write_only: the run re-saves at every checkpoint, purges superseded rows and backfills
+    # dates in place, none of which a write-only workbook allows (it can be saved exactly once).
+    # Rows go through ws.append, the same path write-only mode uses.
     wb = Workbook()
     ws = wb.active
     ws.title = "supplier_invoices"
-    for c, name in enumerate(COLUMNS, start=1):
-        ws.cell(row=1, column=c, value=name)
+    ws.append(COLUMNS)
     ws.freeze_panes = "A2"
     return wb, ws, uid_map
 
 
 
+_ADDRESS_PARTS = ("Street", "BuildingFloor", "AddressDetail", "City", "PostalCode")
+
+# Compiled XPath (lxml trees only): namespace-agnostic matches evaluated in C instead of Python loops.
+if LET is not None:
+    # *Line by localname, case-insensitive on the 'line' suffix (as _localname_lower(...).endswith("line"))
+    _LINE_SUFFIX = "substring(translate(local-name(), 'LINE', 'line'), string-length(local-name()) - 3) = 'line'"
+    _XP_LINE_CHILDREN = LET.XPath(f"./*[{_LINE_SUFFIX}]")
+    _XP_LINE_DESCENDANTS = LET.XPath(f".//*[{_LINE_SUFFIX}]")
+    _XP_ADDRESS_PARTS = LET.XPath("./*[" + " or ".join(f"local-name()='{t}'" for t in _ADDRESS_PARTS) + "]")
+else:  # pragma: no cover - stdlib fallback
+    _XP_LINE_CHILDREN = _XP_LINE_DESCENDANTS = _XP_ADDRESS_PARTS = None
+
+
 def parse_supplier_address(party_el: Optional[ET.Element]) -> str:
     """Best-effort address extraction (namespace-agnostic).
 
@@ -1005,6 +1629,13 @@ def parse_supplier_address(party_el: Optional[ET.Element]) -> str:
     if addr is None:
         return ""
 
+    if LET is not None and LET.iselement(addr):
+        # one XPath for all parts; keep the first child per part, joined in _ADDRESS_PARTS order
+        found: Dict[str, str] = {}
+        for ch in _XP_ADDRESS_PARTS(addr):
+            found.setdefault(_localname(ch.tag), get_text(ch))
+        return ", ".join(t for t in (found.get(tag, "") for tag in _ADDRESS_PARTS) if t)
+
     def _child_text(el: ET.Element, local: str) -> str:
         for ch in list(el):
             if _localname(ch.tag) == local:
@@ -1012,13 +1643,17 @@ def parse_supplier_address(party_el: Optional[ET.Element]) -> str:
         return ""
 
     parts: List[str] = []
-    for tag in ("Street", "BuildingFloor", "AddressDetail", "City", "PostalCode"):
+    for tag in _ADDRESS_PARTS:
         t = _child_text(addr, tag)
         if t:
             parts.append(t)
     return ", ".join(parts)
 
 
+# XMLDSig children of <Dfe> that are never the document node
+_SIGNATURE_TAGS = frozenset({"Signature", "SignedInfo", "KeyInfo"})
+
+
 def _pick_document_node(dfe_root: ET.Element) -> ET.Element:
     """Pick the *primary* fiscal document node from a DFE root.
 
@@ -1029,19 +1664,19 @@ def _pick_document_node(dfe_root: ET.Element) -> ET.Element:
     dtc = (dfe_root.attrib.get("DocumentTypeCode") or "").strip()
     expected = DTC_TO_ELEMENT.get(dtc)
 
-    # First pass: direct child that matches DocumentTypeCode expectation
-    for ch in list(dfe_root):
+    # One pass over direct children: the child matching the DocumentTypeCode expectation wins;
+    # otherwise the first child that is any known document element.
+    first_known: Optional[ET.Element] = None
+    for ch in dfe_root:
         ln = _localname(ch.tag)
-        if ln in ("Signature", "SignedInfo", "KeyInfo"):
+        if ln in _SIGNATURE_TAGS:
             continue
         if expected and ln == expected:
             return ch
-
-    # Second pass: any direct child that matches known document elements
-    for ch in list(dfe_root):
-        ln = _localname(ch.tag)
-        if ln in DOC_ELEMENT_TO_PREFIX:
-            return ch
+        if first_known is None and ln in DOC_ELEMENT_TO_PREFIX:
+            first_known = ch
+    if first_known is not None:
+        return first_known
 
     # Last resort: fallback to deep search
     found = _find_first_by_localnames(dfe_root, list(DOC_ELEMENT_TO_PREFIX.keys()))
@@ -1087,10 +1722,13 @@ def parse_invoice_lines(dfe_root: ET.Element) -> Tuple[Dict[str, Any], List[Dict
         doc_meta["doc_kind"] = DOC_ELEMENT_TO_PREFIX.get(doc_node_name, doc_node_name or "Unknown")
         doc_meta["doc_kind_label"] = DOC_PREFIX_TO_TIPO.get(doc_meta["doc_kind"], "")
 
+    # one walk of the document node answers all the header lookups below
+    doc_idx = index_by_localname(doc_node)
+
     # emitter/supplier info (try under doc_node; fallback anywhere)
     emitter = None
     for cand in ("EmitterParty", "SellerParty", "SupplierParty", "AccountingSupplierParty"):
-        emitter = _find_first_by_localnames(doc_node, [cand])
+        emitter = _first_indexed(doc_idx, [cand])
         if emitter is not None:
             break
     if emitter is None:
@@ -1099,30 +1737,30 @@ def parse_invoice_lines(dfe_root: ET.Element) -> Tuple[Dict[str, Any], List[Dict
     if emitter is not None:
         doc_meta["supplier_name"] = _coalesce(
             _text_anywhere(emitter, ["Name", "PartyName"]),
-            _text_anywhere(doc_node, ["EmitterName", "SupplierName"]),
+            _text_indexed(doc_idx, ["EmitterName", "SupplierName"]),
         )
         doc_meta["supplier_taxid"] = _coalesce(
             _text_anywhere(emitter, ["TaxId", "TaxID", "CompanyID", "VatID"]),
-            _text_anywhere(doc_node, ["TaxId", "TaxID"]),
+            _text_indexed(doc_idx, ["TaxId", "TaxID"]),
         )
         doc_meta["supplier_address"] = parse_supplier_address(emitter)
 
-    # issue date and document number
-    doc_meta["issue_date"] = _coalesce(
-        _text_anywhere(doc_node, ["IssueDate", "IssueDateTime", "AuthorizedDateTime"]),
-        _text_anywhere(dfe_root, ["IssueDate", "IssueDateTime", "AuthorizedDateTime"]),
+    # issue date and document number (only walk the whole DFE when the document node has no date)
+    doc_meta["issue_date"] = (
+        _text_indexed(doc_idx, ["IssueDate", "IssueDateTime", "AuthorizedDateTime"])
+        or _text_anywhere(dfe_root, ["IssueDate", "IssueDateTime", "AuthorizedDateTime"])
     )
 
     # some documents split Serie + DocumentNumber
-    serie = _text_anywhere(doc_node, ["Serie"])
-    docnum = _text_anywhere(doc_node, ["DocumentNumber"])
+    serie = _text_indexed(doc_idx, ["Serie"])
+    docnum = _text_indexed(doc_idx, ["DocumentNumber"])
     if serie and docnum:
         doc_meta["document_number"] = f"{serie}/{docnum}"
     else:
         doc_meta["document_number"] = _coalesce(
             docnum,
             serie,
-            _text_anywhere(doc_node, ["Number", "DocumentId", "DocumentID", "ID"]),
+            _text_indexed(doc_idx, ["Number", "DocumentId", "DocumentID", "ID"]),
         )
 
     # references (for receipts and related docs)
@@ -1135,83 +1773,112 @@ def parse_invoice_lines(dfe_root: ET.Element) -> Tuple[Dict[str, Any], List[Dict
     # We scan all candidate <Lines> elements and take the first that yields actual <...Line> items.
     lines: List[Dict[str, Any]] = []
 
-    def _scan_lines(root: ET.Element) -> List[Dict[str, Any]]:
-        for el in root.iter():
+    def _scan_lines(candidates: Iterable[ET.Element]) -> List[Dict[str, Any]]:
+        for el in candidates:
             if _localname(el.tag) != "Lines":
                 continue
-            parsed = parse_lines(el)
+            parsed = list(iter_line_items(el, release=True))
             if parsed:
                 return parsed
         return []
 
-    lines = _scan_lines(doc_node)
+    lines = _scan_lines(el for _, el in doc_idx.get("lines", ()))
     if not lines and doc_node is not dfe_root:
-        lines = _scan_lines(dfe_root)
+        lines = _scan_lines(dfe_root.iter())
 
     return doc_meta, lines
 
-def parse_lines(lines_el: Optional[ET.Element]) -> List[Dict[str, Any]]:
-    """Parse line items from a <Lines> element.
+def _line_candidates(lines_el: ET.Element) -> List[ET.Element]:
+    """Line nodes under a <Lines> element.
 
     eFatura CV typically uses <Lines><Line>..., but in practice we may see:
     - different namespaces
     - alternative node names (e.g. InvoiceLine/CreditNoteLine)
-    This function is tolerant and uses localname-based fallbacks.
     """
-    if lines_el is None:
-        return []
-    out: List[Dict[str, Any]] = []
-
     # Preferred: DFE namespace Line
-    candidates = list(lines_el.findall("d:Line", NS_DFE))
+    candidates = lines_el.findall(_DFE_LINE_TAG)
+    if candidates:
+        return candidates
+
+    # Next: <Line> in the namespace the <Lines> element itself uses (other schema versions, or no
+    # namespace at all), still a direct path lookup before the localname scans below
+    tag = lines_el.tag if isinstance(lines_el.tag, str) else ""
+    ns = tag[: tag.index("}") + 1] if tag.startswith("{") else ""
+    if ns != _DFE_NS:
+        candidates = lines_el.findall(ns + "Line")
+        if candidates:
+            return candidates
+
+    if LET is not None and LET.iselement(lines_el):
+        # same fallbacks as below, evaluated by libxml2
+        return _XP_LINE_CHILDREN(lines_el) or _XP_LINE_DESCENDANTS(lines_el)
 
     # Fallback: any direct children whose localname endswith 'Line'
-    if not candidates:
-        for ch in list(lines_el):
-            if _localname(ch.tag).lower().endswith("line"):
-                candidates.append(ch)
+    candidates = [ch for ch in lines_el if _is_line_tag(ch.tag)]
+    if candidates:
+        return candidates
 
     # Last resort: any descendant node whose localname endswith 'Line' (can overmatch but better than empty)
-    if not candidates:
-        for ch in lines_el.iter():
-            if ch is lines_el:
-                continue
-            if _localname(ch.tag).lower().endswith("line"):
-                candidates.append(ch)
+    return [ch for ch in lines_el.iter() if ch is not lines_el and _is_line_tag(ch.tag)]
+
+
+# Usual spellings, checked exactly before the case-insensitive suffix test
+_LINE_TAGS = frozenset({"Line", "InvoiceLine", "CreditNoteLine", "DebitNoteLine", "DocumentLine"})
+
+
+def _is_line_tag(tag: str) -> bool:
+    return _localname(tag) in _LINE_TAGS or _localname_lower(tag).endswith("line")
+
+
+def iter_line_items(lines_el: Optional[ET.Element], *, release: bool = False) -> Iterator[Dict[str, Any]]:
+    """Yield one item dict per line of a <Lines> element, in document order.
+
+    Each line is visited once and its dict produced on demand, so callers that stream rows out
+    (or stop early) never hold more than the current item.
+
+    With release=True each <Line> subtree is cleared once its dict is built, so the DOM of the
+    lines is freed while the items are produced (the caller must not read those lines again).
+    """
+    if lines_el is None:
+        return
+
+    for line in _line_candidates(lines_el):
+        # one walk of the line answers every field lookup below
+        idx = index_by_localname(line)
 
-    for line in candidates:
         # qty/unit
-        qty_el = _find_first_by_localnames(line, ["Quantity", "InvoicedQuantity", "CreditedQuantity", "DebitedQuantity"])
+        qty_el = _first_indexed(idx, ["Quantity", "InvoicedQuantity", "CreditedQuantity", "DebitedQuantity"])
         qty = safe_float(get_text(qty_el))
         unit = ""
         if qty_el is not None:
             unit = (qty_el.attrib.get("UnitCode") or qty_el.attrib.get("unitCode") or "").strip()
 
         # prices/totals
-        unit_price = safe_float(_text_anywhere(line, ["Price", "UnitPrice", "PriceAmount"]))
-        ext = safe_float(_text_anywhere(line, ["PriceExtension", "LineExtensionAmount"]))
-        net = safe_float(_text_anywhere(line, ["NetTotal", "LineTotal"]))
-        total = safe_float(_text_anywhere(line, ["Total", "Amount"]))
+        unit_price = safe_float(_text_indexed(idx, ["Price", "UnitPrice", "PriceAmount"]))
+        ext = safe_float(_text_indexed(idx, ["PriceExtension", "LineExtensionAmount"]))
+        net = safe_float(_text_indexed(idx, ["NetTotal", "LineTotal"]))
+        total = safe_float(_text_indexed(idx, ["Total", "Amount"]))
 
         # item details
-        item = _find_first_by_localnames(line, ["Item", "Product", "GoodsItem"])
+        item = _first_indexed(idx, ["Item", "Product", "GoodsItem"])
         item_name = ""
         item_code = ""
         if item is not None:
+            item_idx = index_by_localname(item)
             item_name = _coalesce(
-                _text_anywhere(item, ["Description", "Name", "ItemName"]),
-                _text_anywhere(line, ["Description", "Name"]),
+                _text_indexed(item_idx, ["Description", "Name", "ItemName"]),
+                _text_indexed(idx, ["Description", "Name"]),
             )
             item_code = _coalesce(
-                _text_anywhere(item, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"]),
-                _text_anywhere(line, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"]),
+                _text_indexed(item_idx, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"]),
+                _text_indexed(idx, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"]),
             )
         else:
-            item_name = _text_anywhere(line, ["Description", "Name"])
-            item_code = _text_anywhere(line, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"])
+            item_name = _text_indexed(idx, ["Description", "Name"])
+            item_code = _text_indexed(idx, ["EmitterIdentification", "SellerItemIdentification", "ID", "Code"])
 
         # discount: explicit fields if present; else compute diff where possible
-        discount = safe_float(_text_anywhere(line, ["Discount", "DiscountAmount"]))
+        discount = safe_float(_text_indexed(idx, ["Discount", "DiscountAmount"]))
         if discount is None:
             if ext is not None and qty is not None and unit_price is not None:
                 discount = round(max(unit_price * qty - ext, 0.0), 2)
@@ -1227,56 +1894,89 @@ def parse_lines(lines_el: Optional[ET.Element]) -> List[Dict[str, Any]]:
         if line_total is None and qty is not None and unit_price is not None:
             line_total = round(qty * unit_price, 2)
 
-        out.append(
-            {
-                "item_code": item_code,
-                "item_name": item_name,
-                "qty": qty,
-                "unit": unit,
-                "unit_price": unit_price,
-                "discount": discount,
-                "line_total": line_total,
-            }
-        )
-    return out
+        item = {
+            "item_code": item_code,
+            "item_name": item_name,
+            "qty": qty,
+            "unit": unit,
+            "unit_price": unit_price,
+            "discount": discount,
+            "line_total": line_total,
+        }
+        if release:
+            line.clear()
+        yield item
+
+
+def parse_lines(lines_el: Optional[ET.Element]) -> List[Dict[str, Any]]:
+    """Parse line items from a <Lines> element (tolerant, localname-based; see iter_line_items)."""
+    return list(iter_line_items(lines_el))
+
+
+_ERROR_ROW_LEN = _COL["last_updated"]
+
 
 def append_error_row(ws: Worksheet, uid: str, reason: str) -> None:
-    col = {name: (COLUMNS.index(name) + 1) for name in COLUMNS}
-    r = ws.max_row + 1
-    ws.cell(row=r, column=col["UID"], value=uid)
-    ws.cell(row=r, column=col["Erro"], value=reason)
-    ws.cell(row=r, column=col["last_updated"], value=now_local_iso())
+    """Append a row carrying only UID, Erro and last_updated (other cells stay empty)."""
+    row: List[Any] = [None] * _ERROR_ROW_LEN
+    row[_COL["UID"] - 1] = uid
+    row[_COL["Erro"] - 1] = reason
+    row[-1] = now_local_iso()  # last_updated
+    ws.append(row)
+
+
+
+# One exported line, in COLUMNS order up to last_updated ("Exported" is left empty for downstream tools).
+RowTuple = Tuple[
+    str, str, str, str, str, str, str, str, str,    # UID .. Numero Documento
+    str, str, Optional[float], str,                 # Código Artigo, Nome Artigo, Quantidade, Unidade Medida
+    Optional[float], Optional[float], Optional[float],  # Preço Unitário, Desconto, Preço Total (linha)
+    str,                                            # last_updated
+]
+
+
+# Item columns of a parsed line (iter_line_items always sets every key), extracted as one C-level tuple:
+# Código Artigo, Nome Artigo, Quantidade, Unidade Medida, Preço Unitário, Desconto, Preço Total (linha)
+_LINE_COLUMNS = operator.itemgetter("item_code", "item_name", "qty", "unit", "unit_price", "discount", "line_total")
 
 
+def iter_line_rows(uid: str, efatura_date: str, meta: Dict[str, Any], lines: Iterable[Dict[str, Any]]) -> Iterator[RowTuple]:
+    """Yield the Excel rows of one document as plain tuples in COLUMNS order.
+
+    Document-level values (supplier, dates, type, number, timestamp) are resolved once and shared by
+    every line; the item columns of each line are pulled out in one itemgetter call, so a row is just
+    three tuples concatenated.
+    """
+    head = (
+        uid,                                # UID
+        "",                                 # Erro
+        meta.get("supplier_name", ""),      # Nome Fornecedor
+        meta.get("supplier_taxid", ""),     # NIF Fornecedor
+        meta.get("supplier_address", ""),   # Morada Fornecedor
+        efatura_date or "",                 # Data eFatura
+        meta.get("issue_date", ""),         # Data Documento
+        infer_tipo_documento(meta.get("document_number", ""), meta.get("doc_kind", "")),  # Tipo de Documento
+        meta.get("document_number", ""),    # Numero Documento
+    )
+    tail = (now_local_iso(),)               # last_updated
+    item_columns = _LINE_COLUMNS
+    for ln in lines:
+        yield head + item_columns(ln) + tail
+
 
 def append_line_rows(ws: Worksheet, uid: str, efatura_date: str, meta: Dict[str, Any], lines: List[Dict[str, Any]]) -> int:
     """
     Append one row per line item. Returns number of rows added.
-    """
-    col = {name: (COLUMNS.index(name) + 1) for name in COLUMNS}
-    tipo_doc = infer_tipo_documento(meta.get("document_number", ""), meta.get("doc_kind", ""))
 
-    before = ws.max_row
-    for ln in lines:
-        r = ws.max_row + 1
-        ws.cell(row=r, column=col["UID"], value=uid)
-        ws.cell(row=r, column=col["Erro"], value="")
-        ws.cell(row=r, column=col["Nome Fornecedor"], value=meta.get("supplier_name", ""))
-        ws.cell(row=r, column=col["NIF Fornecedor"], value=meta.get("supplier_taxid", ""))
-        ws.cell(row=r, column=col["Morada Fornecedor"], value=meta.get("supplier_address", ""))
-        ws.cell(row=r, column=col["Data eFatura"], value=efatura_date or "")
-        ws.cell(row=r, column=col["Data Documento"], value=meta.get("issue_date", ""))
-        ws.cell(row=r, column=col["Tipo de Documento"], value=tipo_doc)
-        ws.cell(row=r, column=col["Numero Documento"], value=meta.get("document_number", ""))
-        ws.cell(row=r, column=col["Código Artigo"], value=ln.get("item_code", ""))
-        ws.cell(row=r, column=col["Nome Artigo"], value=ln.get("item_name", ""))
-        ws.cell(row=r, column=col["Quantidade"], value=ln.get("qty"))
-        ws.cell(row=r, column=col["Unidade Medida"], value=ln.get("unit", ""))
-        ws.cell(row=r, column=col["Preço Unitário"], value=ln.get("unit_price"))
-        ws.cell(row=r, column=col["Desconto"], value=ln.get("discount"))
-        ws.cell(row=r, column=col["Preço Total (linha)"], value=ln.get("line_total"))
-        ws.cell(row=r, column=col["last_updated"], value=now_local_iso())
-    return ws.max_row - before
+    Rows are streamed from iter_line_rows() straight into ws.append(), which avoids the per-cell
+    coordinate handling of ws.cell() (the dominant cost when exporting many lines).
+    """
+    added = 0
+    append = ws.append
+    for row in iter_line_rows(uid, efatura_date, meta, lines):
+        append(row)
+        added += 1
+    return added
 
 
 
@@ -1285,18 +1985,21 @@ def backfill_efatura_dates(ws: Worksheet, uid_row_map: Dict[str, List[int]], uid
     Fill 'Data eFatura' for existing rows when empty.
     Returns number of rows updated.
     """
-    col_ef = COLUMNS.index("Data eFatura") + 1
-    col_last = COLUMNS.index("last_updated") + 1
+    col_ef = _COL["Data eFatura"]
+    col_last = _COL["last_updated"]
+    stamp = now_local_iso()  # one timestamp for the whole backfill pass
+    cell = ws.cell
     updated = 0
     for uid, rows in uid_row_map.items():
         ef = uid_to_efdate.get(uid)
         if not ef:
             continue
         for r in rows:
-            cur = ws.cell(row=r, column=col_ef).value
-            if cur is None or str(cur).strip() == "":
-                ws.cell(row=r, column=col_ef, value=ef)
-                ws.cell(row=r, column=col_last, value=now_local_iso())
+            ef_cell = cell(row=r, column=col_ef)
+            cur = ef_cell.value
+            if cur is None or (isinstance(cur, str) and not cur.strip()):
+                ef_cell.value = ef
+                cell(row=r, column=col_last).value = stamp
                 updated += 1
     return updated
 
@@ -1304,7 +2007,7 @@ def backfill_efatura_dates(ws: Worksheet, uid_row_map: Dict[str, List[int]], uid
 def load_token_json(path: Path) -> str:
     if not path.exists():
         raise FileNotFoundError(f"token.json not found: {path}")
-    obj = json.loads(path.read_text(encoding="utf-8"))
+    obj = _json_loads(path.read_bytes())
     tok = obj.get("access_token")
     if not tok:
         raise ValueError("token.json missing access_token")
@@ -1326,6 +2029,7 @@ def main() -> int:
     ap.add_argument("--save-every-seconds", type=int, default=-1, help="Save Excel every N seconds (0 disables; -1 uses INI)")
     ap.add_argument("--log-file", default="", help="Path to log file (default: base_dir/logs/update_supplier_invoices_YYYYmmdd_HHMMSS.log)")
     ap.add_argument("--rewrite-existing", action="store_true", help="If UID already exists in Excel, delete its rows and rewrite it (WARNING: can re-download many docs if used broadly).")
+    ap.add_argument("--sort-uids", action="store_true", help="Process UIDs in sorted order instead of the listing (API) order")
     args = ap.parse_args()
 
     cfg = load_config(Path(args.config).expanduser(), verbose=args.verbose)
@@ -1392,6 +2096,8 @@ def main() -> int:
         retries=cfg.retries,
         backoff_sec=cfg.backoff_sec,
         verbose=args.verbose,
+        max_concurrency=cfg.max_concurrency,
+        on_token_rejected=auth.invalidate,
     )
 
     # userinfo (best effort)
@@ -1436,13 +2142,15 @@ def main() -> int:
     if discovered_date_keys:
         log(f"Discovered possible 'Data eFatura' fields in listing: {', '.join(discovered_date_keys)}")
 
-    uid_to_item: Dict[str, Dict[str, Any]] = {}
+    # one pass over the listing; only the UIDs and their dates are kept, the records are then released
+    # dict as an ordered set: keeps the listing (API) order
+    listed_uids: Dict[str, None] = {}
     uid_to_efdate: Dict[str, str] = {}
     for it in records:
         uid = extract_uid_from_item(it)
         if not uid:
             continue
-        uid_to_item[uid] = it
+        listed_uids.setdefault(uid)
         efdate = extract_efatura_date_from_item(it)
         if efdate:
             uid_to_efdate[uid] = efdate
@@ -1452,7 +2160,8 @@ def main() -> int:
     if filled:
         log(f"Backfilled 'Data eFatura' for {filled} existing rows.")
 
-    uids = sorted(uid_to_item.keys())
+    del records
+    uids = sorted(listed_uids) if args.sort_uids else list(listed_uids)
     log(f"Total UIDs discovered in date range: {len(uids)}")
 
     added_docs = 0
@@ -1460,59 +2169,103 @@ def main() -> int:
     errors = 0
 
     last_save_ts = time.time()
+    last_save_cost = 0.0
     docs_since_save = 0
+    # Rows superseded by a UID rewrite (tombstones); purged in one pass right before each save.
+    stale_rows: List[int] = []
+    # payload fingerprint -> first UID that returned it (every DFE embeds its own id, so a repeat is a portal fault)
+    seen_payloads: Dict[bytes, str] = {}
+
+    def save_now(compress_level: int = CHECKPOINT_COMPRESS_LEVEL) -> None:
+        nonlocal last_save_ts, last_save_cost, docs_since_save
+        t0 = time.time()
+        if stale_rows:
+            purged = purge_rows(ws, stale_rows)
+            stale_rows.clear()
+            # row indices shifted: rebuild the UID index
+            uid_row_map.clear()
+            uid_row_map.update(index_uid_rows(ws))
+            log(f"Purged {purged} superseded row(s) from Excel.")
+        safe_save_workbook(wb, cfg.excel_path, compress_level=compress_level)
+        # flush any coalesced resume progress so it matches what is now on disk
+        save_resume_state(resume_state_path, resume_state, force=True)
+        last_save_ts = time.time()
+        last_save_cost = last_save_ts - t0
+        docs_since_save = 0
+        log(f"Excel checkpoint saved: {cfg.excel_path}")
 
     def checkpoint_save(force: bool = False) -> None:
-        nonlocal last_save_ts, docs_since_save
         if force:
-            safe_save_workbook(wb, cfg.excel_path)
-            last_save_ts = time.time()
-            docs_since_save = 0
-            log(f"Excel checkpoint saved: {cfg.excel_path}")
+            save_now(FINAL_COMPRESS_LEVEL)
             return
 
-        if cfg.save_every_docs == 0 and cfg.save_every_seconds == 0:
+        if docs_since_save == 0 or (cfg.save_every_docs == 0 and cfg.save_every_seconds == 0):
             return
 
-        due_by_docs = cfg.save_every_docs > 0 and docs_since_save >= cfg.save_every_docs
-        due_by_time = cfg.save_every_seconds > 0 and (time.time() - last_save_ts) >= cfg.save_every_seconds
+        since_save = time.time() - last_save_ts
+        due_by_docs = (
+            cfg.save_every_docs > 0
+            and docs_since_save >= cfg.save_every_docs
+            and since_save >= last_save_cost * CHECKPOINT_SAVE_COST_FACTOR
+        )
+        due_by_time = cfg.save_every_seconds > 0 and since_save >= cfg.save_every_seconds
         if due_by_docs or due_by_time:
-            safe_save_workbook(wb, cfg.excel_path)
-            last_save_ts = time.time()
-            docs_since_save = 0
-            log(f"Excel checkpoint saved: {cfg.excel_path}")
-
-
-    for idx, uid in enumerate(uids, start=1):
+            save_now()
+
+    # Documents that will actually be downloaded, in UID order: UIDs already in the Excel are dropped
+    # up front (unless rewriting, or the interrupted resume UID). The loop walks this list and the
+    # prefetcher fetches ahead in the same order while the loop stays the only writer.
+    to_fetch = [u for u in uids if args.rewrite_existing or u == resume_uid or u not in existing_uids]
+    if len(to_fetch) < len(uids):
+        log(f"{len(uids) - len(to_fetch)} UID(s) already in Excel -> skip; {len(to_fetch)} to download.")
+    bad_dir = BAD_RESPONSE_DIR or (cfg.log_file.parent / "bad_responses")
+    # documents without lines of this run, one JSON line each ({"uid", "xml"})
+    no_lines_dump = cfg.log_file.parent / "no_lines" / f"no_lines_{dt.datetime.now():%Y%m%d_%H%M%S}.jsonl.gz"
+
+    def parse_inner(doc_uid: str, xml: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        return parse_invoice_lines(safe_parse_xml(xml, uid=doc_uid, stage="inner", dump_dir=bad_dir))
+
+    # XML parsing runs in the prefetch workers too (lxml releases the GIL while parsing)
+    prefetcher = DfePrefetcher(client, to_fetch, cfg.max_concurrency, parse=parse_inner, seen_digests=seen_payloads)
+    if cfg.max_concurrency > 1:
+        log(f"Prefetching documents with max_concurrency={cfg.max_concurrency}.")
+
+    progress_every = max(1, cfg.progress_every)
+    for idx, uid in enumerate(to_fetch, start=1):
         if args.max_docs and added_docs >= args.max_docs:
             log(f"Reached --max-docs={args.max_docs}, stopping.")
             break
 
-        uid_exists = uid in existing_uids
-        should_rewrite = args.rewrite_existing or (resume_uid == uid)
-
-        if uid_exists and not should_rewrite:
-            if idx % max(1, cfg.progress_every) == 0:
-                log(f"[{idx}/{len(uids)}] UID={uid} already in Excel -> skip")
-            continue
-
-        if uid_exists and should_rewrite:
-            deleted = delete_uid_rows(ws, uid)
-            if deleted:
-                log(f"UID={uid} already existed in Excel: deleted {deleted} row(s) to rewrite document.")
-            # Keep existing_uids set; UID still considered known.
+        superseded: List[int] = []
+        if uid in existing_uids:
+            # Tombstone the old rows; the rewritten document is appended and the old rows are purged
+            # before the next save. Keep existing_uids set; UID still considered known.
+            superseded = uid_row_map.pop(uid, [])
+            if superseded:
+                stale_rows.extend(superseded)
+                log(f"UID={uid} already existed in Excel: {len(superseded)} row(s) superseded to rewrite document.")
 
         # Mark started (resume checkpoint)
         resume_state["started_uid"] = uid
         save_resume_state(resume_state_path, resume_state)
 
-        log(f"[{idx}/{len(uids)}] UID={uid} fetching document XML...")
+        log(f"[{idx}/{len(to_fetch)}] UID={uid} fetching document XML...")
         efdate = uid_to_efdate.get(uid, "")
 
         try:
-            inner_xml = client.fetch_dfe_inner_xml(uid)
-            dfe_root = safe_parse_xml(inner_xml, uid=uid, stage="inner", dump_dir=(BAD_RESPONSE_DIR or (cfg.log_file.parent / "bad_responses")))
-            meta, lines = parse_invoice_lines(dfe_root)
+            inner_xml, digest, parsed, parse_error = prefetcher.get_parsed(uid)
+            first_uid = seen_payloads.setdefault(digest, uid)
+            if first_uid != uid:
+                # Portal fault: the same XML served for two UIDs. Nothing is written and the UID is not
+                # marked known/completed, so the next run fetches it again.
+                if superseded:
+                    del stale_rows[-len(superseded):]
+                    uid_row_map[uid] = superseded
+                log(f"WARNING: UID={uid} returned the same XML as UID={first_uid}; skipped (retried next run).")
+                continue
+            if parse_error is not None:
+                raise parse_error
+            meta, lines = parsed
 
             # If we have no lines, try to follow referenced FiscalDocument UIDs (receipts, notes, etc.)
             if not lines:
@@ -1523,7 +2276,7 @@ def main() -> int:
                     log(f"UID={uid} has no lines; trying referenced FiscalDocument {ref_uid}...")
                     try:
                         inner2 = client.fetch_dfe_inner_xml(ref_uid)
-                        root2 = safe_parse_xml(inner2, uid=ref_uid, stage="inner_ref", dump_dir=(BAD_RESPONSE_DIR or (cfg.log_file.parent / "bad_responses")))
+                        root2 = safe_parse_xml(inner2, uid=ref_uid, stage="inner_ref", dump_dir=bad_dir)
                         meta2, lines2 = parse_invoice_lines(root2)
                     except Exception as e:
                         log(f"WARNING: referenced fetch/parse failed ref_uid={ref_uid}: {e}")
@@ -1540,9 +2293,7 @@ def main() -> int:
             if not lines:
                 # Dump the raw inner xml for forensic analysis (helps identify unexpected schemas)
                 try:
-                    nl_dir = cfg.log_file.parent / "no_lines"
-                    nl_dir.mkdir(parents=True, exist_ok=True)
-                    dump_text(nl_dir / f"{uid}.inner.xml", inner_xml)
+                    append_dump_record(no_lines_dump, {"uid": uid, "xml": inner_xml})
                 except Exception as _e:
                     log(f"WARNING: failed to dump no-lines XML for uid={uid}: {_e}")
 
@@ -1558,28 +2309,25 @@ def main() -> int:
                 )
                 errors += 1
                 existing_uids.add(uid)
-                uid_row_map.setdefault(uid, []).append(ws.max_row)
+                uid_row_map.setdefault(uid, []).append(last_row(ws))
                 log(f"WARNING: UID={uid} has no lines; recorded as error. kind={doc_kind} num={doc_num} refs={refs_s}")
 
                 # Mark completed (resume checkpoint)
-                resume_state["completed_uid"] = uid
-                save_resume_state(resume_state_path, resume_state)
+                resume_state["completed_uid"] = uid  # persisted by the next state write
                 docs_since_save += 1
                 checkpoint_save()
                 continue
 
-            before = ws.max_row
             rows_added = append_line_rows(ws, uid, efdate, meta, lines)
-            after = ws.max_row
+            after = last_row(ws)
             added_rows += rows_added
             added_docs += 1
             existing_uids.add(uid)
             # record new uid rows for future backfill
-            uid_row_map[uid] = list(range(before + 1, after + 1))
+            uid_row_map[uid] = list(range(after - rows_added + 1, after + 1))
 
             # Mark completed (resume checkpoint)
-            resume_state["completed_uid"] = uid
-            save_resume_state(resume_state_path, resume_state)
+            resume_state["completed_uid"] = uid  # persisted by the next state write
             if resume_uid == uid:
                 resume_uid = None
 
@@ -1596,20 +2344,22 @@ def main() -> int:
             append_error_row(ws, uid, str(e)[:500])
             errors += 1
             existing_uids.add(uid)
-            uid_row_map.setdefault(uid, []).append(ws.max_row)
+            uid_row_map.setdefault(uid, []).append(last_row(ws))
             log_exception(f"WARNING: Failed UID={uid}: {e}")
 
             # Mark completed (resume checkpoint)
-            resume_state["completed_uid"] = uid
-            save_resume_state(resume_state_path, resume_state)
+            resume_state["completed_uid"] = uid  # persisted by the next state write
             if resume_uid == uid:
                 resume_uid = None
             docs_since_save += 1
             checkpoint_save()
 
-        if (idx % max(1, cfg.progress_every)) == 0:
-            log(f"Progress: processed={idx}/{len(uids)} added_docs={added_docs} added_rows={added_rows} errors={errors}")
+        if (idx % progress_every) == 0:
+            log(f"Progress: processed={idx}/{len(to_fetch)} added_docs={added_docs} added_rows={added_rows} errors={errors}")
 
+    prefetcher.close()
+    client.close()
+    auth.close()
     checkpoint_save(force=True)
     log(f"DONE. Added docs={added_docs}, rows={added_rows}, errors={errors}. Excel saved: {cfg.excel_path}")
     return 0
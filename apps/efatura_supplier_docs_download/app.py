@@ -3,8 +3,10 @@ Mini app: Descarrega facturas de fornecedores do eFatura CV.
 """
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple
 
 # Adicionar o diretório app ao path para importar o código existente
 _app_dir = Path(__file__).parent.parent.parent / "app"
@@ -18,22 +20,29 @@ from update_supplier_invoices import (
     log,
     log_exception,
     EfaturaClient,
+    DfePrefetcher,
     ensure_workbook,
     load_resume_state,
     save_resume_state,
     compute_resume_uid,
-    delete_uid_rows,
+    purge_rows,
+    index_uid_rows,
+    last_row,
     extract_uid_from_item,
     extract_efatura_date_from_item,
     backfill_efatura_dates,
     safe_parse_xml,
     parse_invoice_lines,
+    decode_jwt_exp_unverified,
     append_error_row,
     append_line_rows,
     resolve_or_fail,
     safe_save_workbook,
-    dump_text,
+    append_dump_record,
     BAD_RESPONSE_DIR,
+    CHECKPOINT_SAVE_COST_FACTOR,
+    CHECKPOINT_COMPRESS_LEVEL,
+    FINAL_COMPRESS_LEVEL,
 )
 
 from core.base_app import BaseApp, AppResult
@@ -67,8 +76,10 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
             "config_file": "caminho/para/config.ini",  # obrigatório
             "max_docs": 0,  # opcional, 0 = sem limite
             "rewrite_existing": false,  # opcional
+            "sort_uids": false,  # opcional, true = ordenar UIDs em vez da ordem da API
             "save_every_docs": -1,  # opcional, -1 = usar INI
             "save_every_seconds": -1,  # opcional, -1 = usar INI
+            "max_concurrency": -1,  # opcional, -1 = usar INI
             "verbose": false  # opcional
         }
         """
@@ -123,13 +134,19 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 cfg.save_every_docs = max(0, int(config["save_every_docs"]))
             if "save_every_seconds" in config and config["save_every_seconds"] != -1:
                 cfg.save_every_seconds = max(0, int(config["save_every_seconds"]))
+            if "max_concurrency" in config and config["max_concurrency"] != -1:
+                cfg.max_concurrency = max(1, int(config["max_concurrency"]))
             
             log(f"Base dir: {cfg.base_dir}")
             log(f"Excel: {cfg.excel_path}")
             
-            # 6. DNS preflight
+            # 6. DNS preflight (as duas resoluções correm em paralelo)
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                dns_services = pool.submit(resolve_or_fail, "services.efatura.cv")
+                dns_iam = pool.submit(resolve_or_fail, "iam.efatura.cv")
+            
             try:
-                ips_services = resolve_or_fail("services.efatura.cv")
+                ips_services = dns_services.result()
                 log(f"DNS OK: services.efatura.cv -> {', '.join(ips_services)}")
             except Exception as e:
                 return AppResult(
@@ -138,7 +155,7 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 )
             
             try:
-                ips_iam = resolve_or_fail("iam.efatura.cv")
+                ips_iam = dns_iam.result()
                 log(f"DNS OK: iam.efatura.cv -> {', '.join(ips_iam)}")
             except Exception as e:
                 log(f"WARNING: {e} (userinfo/refresh may fail)")
@@ -154,11 +171,12 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 retries=cfg.retries,
                 client_secret=cfg.auth_client_secret,
             )
+            self._auth = auth
             auth.migrate_legacy_tokens(cfg.token_json)
             access_token_provider = lambda: auth.get_valid_access_token()
 
             try:
-                _ = access_token_provider()
+                access_token = access_token_provider()
             except EfaturaAuthNeedsReauth:
                 return AppResult(
                     success=False,
@@ -173,19 +191,37 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 retries=cfg.retries,
                 backoff_sec=cfg.backoff_sec,
                 verbose=verbose,
+                max_concurrency=cfg.max_concurrency,
+                on_token_rejected=auth.invalidate,
             )
+            # Fechado em cleanup(), também quando run() termina cedo
+            self._client = client
             
-            # 9. Validar token com userinfo
-            try:
-                taxid = client.userinfo_taxid()
-                log(f"eFatura userinfo OK: {taxid}")
-            except PermissionError:
-                return AppResult(
-                    success=False,
-                    message="TOKEN_EXPIRED_OR_INVALID (userinfo)."
-                )
-            except Exception as e:
-                log(f"WARNING: userinfo failed: {e} (continuing)")
+            # 9. Validar token com userinfo (dispensado se outra app do mesmo contexto já validou
+            #    este token e ele ainda tem pelo menos 60s de validade)
+            cached_taxid = context.shared_data.get("efatura_taxid")
+            if (
+                cached_taxid
+                and context.access_token == access_token
+                and context.token_expiry is not None
+                and context.token_expiry > datetime.now() + timedelta(seconds=60)
+            ):
+                log(f"eFatura userinfo OK (token já validado neste contexto): {cached_taxid}")
+            else:
+                try:
+                    taxid = client.userinfo_taxid()
+                    log(f"eFatura userinfo OK: {taxid}")
+                    exp = decode_jwt_exp_unverified(access_token)
+                    context.access_token = access_token
+                    context.token_expiry = datetime.fromtimestamp(exp) if exp else None
+                    context.shared_data["efatura_taxid"] = taxid
+                except PermissionError:
+                    return AppResult(
+                        success=False,
+                        message="TOKEN_EXPIRED_OR_INVALID (userinfo)."
+                    )
+                except Exception as e:
+                    log(f"WARNING: userinfo failed: {e} (continuing)")
             
             # 10. Preparar Excel
             wb, ws, uid_row_map = ensure_workbook(cfg.excel_path)
@@ -220,13 +256,15 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 log(f"Discovered possible 'Data eFatura' fields: {', '.join(discovered_date_keys)}")
             
             # 13. Processar UIDs
-            uid_to_item: Dict[str, Dict[str, Any]] = {}
+            # Uma passagem pela listagem: guardam-se só os UIDs e as datas; os registos são libertados a seguir
+            # dict como conjunto ordenado: mantém a ordem da listagem (API)
+            listed_uids: Dict[str, None] = {}
             uid_to_efdate: Dict[str, str] = {}
             for it in records:
                 uid = extract_uid_from_item(it)
                 if not uid:
                     continue
-                uid_to_item[uid] = it
+                listed_uids.setdefault(uid)
                 efdate = extract_efatura_date_from_item(it)
                 if efdate:
                     uid_to_efdate[uid] = efdate
@@ -236,7 +274,8 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
             if filled:
                 log(f"Backfilled 'Data eFatura' for {filled} existing rows.")
             
-            uids = sorted(uid_to_item.keys())
+            del records
+            uids = sorted(listed_uids) if config.get("sort_uids", False) else list(listed_uids)
             log(f"Total UIDs discovered in date range: {len(uids)}")
             
             # 14. Processar cada documento
@@ -247,62 +286,99 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
             rewrite_existing = config.get("rewrite_existing", False)
             
             last_save_ts = time.time()
+            last_save_cost = 0.0
             docs_since_save = 0
+            # Linhas substituídas por reescrita de UID (tombstones); removidas de uma vez antes de cada gravação
+            stale_rows: List[int] = []
+            # Impressão digital do XML -> primeiro UID que o devolveu (cada DFE traz o seu id; repetição = falha do portal)
+            seen_payloads: Dict[bytes, str] = {}
+            
+            def save_now(compress_level: int = CHECKPOINT_COMPRESS_LEVEL) -> None:
+                nonlocal last_save_ts, last_save_cost, docs_since_save
+                t0 = time.time()
+                if stale_rows:
+                    purged = purge_rows(ws, stale_rows)
+                    stale_rows.clear()
+                    uid_row_map.clear()
+                    uid_row_map.update(index_uid_rows(ws))
+                    log(f"Purged {purged} superseded row(s) from Excel.")
+                safe_save_workbook(wb, cfg.excel_path, compress_level=compress_level)
+                # Alinhar o estado de retoma (gravações agrupadas) com o Excel acabado de gravar
+                save_resume_state(resume_state_path, resume_state, force=True)
+                last_save_ts = time.time()
+                last_save_cost = last_save_ts - t0
+                docs_since_save = 0
+                log(f"Excel checkpoint saved: {cfg.excel_path}")
             
             def checkpoint_save(force: bool = False) -> None:
-                nonlocal last_save_ts, docs_since_save
                 if force:
-                    safe_save_workbook(wb, cfg.excel_path)
-                    last_save_ts = time.time()
-                    docs_since_save = 0
-                    log(f"Excel checkpoint saved: {cfg.excel_path}")
+                    save_now(FINAL_COMPRESS_LEVEL)
                     return
                 
-                if cfg.save_every_docs == 0 and cfg.save_every_seconds == 0:
+                if docs_since_save == 0 or (cfg.save_every_docs == 0 and cfg.save_every_seconds == 0):
                     return
                 
-                due_by_docs = cfg.save_every_docs > 0 and docs_since_save >= cfg.save_every_docs
-                due_by_time = cfg.save_every_seconds > 0 and (time.time() - last_save_ts) >= cfg.save_every_seconds
+                # Checkpoints por nº de documentos esperam pelo menos N x a duração da última gravação
+                since_save = time.time() - last_save_ts
+                due_by_docs = (
+                    cfg.save_every_docs > 0
+                    and docs_since_save >= cfg.save_every_docs
+                    and since_save >= last_save_cost * CHECKPOINT_SAVE_COST_FACTOR
+                )
+                due_by_time = cfg.save_every_seconds > 0 and since_save >= cfg.save_every_seconds
                 if due_by_docs or due_by_time:
-                    safe_save_workbook(wb, cfg.excel_path)
-                    last_save_ts = time.time()
-                    docs_since_save = 0
-                    log(f"Excel checkpoint saved: {cfg.excel_path}")
+                    save_now()
+            
+            # Documentos a descarregar, por ordem de UID: os que já estão no Excel saem logo aqui (salvo
+            # reescrita ou o UID interrompido a retomar). O ciclo percorre esta lista; os pedidos são feitos
+            # em paralelo e o XML é logo interpretado nos workers; o ciclo continua a ser o único a
+            # escrever no Excel e no estado de retoma.
+            to_fetch = [u for u in uids if rewrite_existing or u == resume_uid or u not in existing_uids]
+            if len(to_fetch) < len(uids):
+                log(f"{len(uids) - len(to_fetch)} UID(s) already in Excel -> skip; {len(to_fetch)} to download.")
             
-            for idx, uid in enumerate(uids, start=1):
+            def parse_inner(doc_uid: str, xml: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+                return parse_invoice_lines(safe_parse_xml(xml, uid=doc_uid, stage="inner", dump_dir=BAD_RESPONSE_DIR))
+            
+            prefetcher = DfePrefetcher(client, to_fetch, cfg.max_concurrency, parse=parse_inner, seen_digests=seen_payloads)
+            self._prefetcher = prefetcher
+            if cfg.max_concurrency > 1:
+                log(f"Prefetching documents with max_concurrency={cfg.max_concurrency}.")
+            
+            progress_every = max(1, cfg.progress_every)
+            for idx, uid in enumerate(to_fetch, start=1):
                 if max_docs and added_docs >= max_docs:
                     log(f"Reached max_docs={max_docs}, stopping.")
                     break
                 
-                uid_exists = uid in existing_uids
-                should_rewrite = rewrite_existing or (resume_uid == uid)
-                
-                if uid_exists and not should_rewrite:
-                    if idx % max(1, cfg.progress_every) == 0:
-                        log(f"[{idx}/{len(uids)}] UID={uid} already in Excel -> skip")
-                    continue
-                
-                if uid_exists and should_rewrite:
-                    deleted = delete_uid_rows(ws, uid)
-                    if deleted:
-                        log(f"UID={uid} already existed: deleted {deleted} row(s) to rewrite.")
+                superseded: List[int] = []
+                if uid in existing_uids:
+                    superseded = uid_row_map.pop(uid, [])
+                    if superseded:
+                        stale_rows.extend(superseded)
+                        log(f"UID={uid} already existed: {len(superseded)} row(s) superseded to rewrite.")
                 
                 # Mark started
                 resume_state["started_uid"] = uid
                 save_resume_state(resume_state_path, resume_state)
                 
-                log(f"[{idx}/{len(uids)}] UID={uid} fetching document XML...")
+                log(f"[{idx}/{len(to_fetch)}] UID={uid} fetching document XML...")
                 efdate = uid_to_efdate.get(uid, "")
                 
                 try:
-                    inner_xml = client.fetch_dfe_inner_xml(uid)
-                    dfe_root = safe_parse_xml(
-                        inner_xml, 
-                        uid=uid, 
-                        stage="inner", 
-                        dump_dir=BAD_RESPONSE_DIR
-                    )
-                    meta, lines = parse_invoice_lines(dfe_root)
+                    inner_xml, digest, parsed, parse_error = prefetcher.get_parsed(uid)
+                    first_uid = seen_payloads.setdefault(digest, uid)
+                    if first_uid != uid:
+                        # Falha do portal (mesmo XML para dois UIDs): nada é escrito nem marcado como
+                        # concluído, para o UID ser descarregado de novo na próxima execução
+                        if superseded:
+                            del stale_rows[-len(superseded):]
+                            uid_row_map[uid] = superseded
+                        log(f"WARNING: UID={uid} returned the same XML as UID={first_uid}; skipped (retried next run).")
+                        continue
+                    if parse_error is not None:
+                        raise parse_error
+                    meta, lines = parsed
                     
                     # Tentar seguir referências se não houver linhas
                     if not lines:
@@ -336,7 +412,7 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                         # Dump para análise
                         try:
                             nl_dir = context.get_or_create_logdir("no_lines")
-                            dump_text(nl_dir / f"{uid}.inner.xml", inner_xml)
+                            append_dump_record(nl_dir / f"no_lines_{context.run_id}.jsonl.gz", {"uid": uid, "xml": inner_xml})
                         except Exception as _e:
                             log(f"WARNING: failed to dump no-lines XML: {_e}")
                         
@@ -352,26 +428,23 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                         )
                         errors += 1
                         existing_uids.add(uid)
-                        uid_row_map.setdefault(uid, []).append(ws.max_row)
+                        uid_row_map.setdefault(uid, []).append(last_row(ws))
                         log(f"WARNING: UID={uid} has no lines; recorded as error.")
                         
-                        resume_state["completed_uid"] = uid
-                        save_resume_state(resume_state_path, resume_state)
+                        resume_state["completed_uid"] = uid  # persisted by the next state write
                         docs_since_save += 1
                         checkpoint_save()
                         continue
                     
                     # Adicionar linhas ao Excel
-                    before = ws.max_row
                     rows_added = append_line_rows(ws, uid, efdate, meta, lines)
-                    after = ws.max_row
+                    after = last_row(ws)
                     added_rows += rows_added
                     added_docs += 1
                     existing_uids.add(uid)
-                    uid_row_map[uid] = list(range(before + 1, after + 1))
+                    uid_row_map[uid] = list(range(after - rows_added + 1, after + 1))
                     
-                    resume_state["completed_uid"] = uid
-                    save_resume_state(resume_state_path, resume_state)
+                    resume_state["completed_uid"] = uid  # persisted by the next state write
                     if resume_uid == uid:
                         resume_uid = None
                     
@@ -389,18 +462,19 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                     append_error_row(ws, uid, str(e)[:500])
                     errors += 1
                     existing_uids.add(uid)
-                    uid_row_map.setdefault(uid, []).append(ws.max_row)
+                    uid_row_map.setdefault(uid, []).append(last_row(ws))
                     log_exception(f"WARNING: Failed UID={uid}: {e}")
                     
-                    resume_state["completed_uid"] = uid
-                    save_resume_state(resume_state_path, resume_state)
+                    resume_state["completed_uid"] = uid  # persisted by the next state write
                     if resume_uid == uid:
                         resume_uid = None
                     docs_since_save += 1
                     checkpoint_save()
                 
-                if (idx % max(1, cfg.progress_every)) == 0:
-                    log(f"Progress: processed={idx}/{len(uids)} added_docs={added_docs} added_rows={added_rows} errors={errors}")
+                if (idx % progress_every) == 0:
+                    log(f"Progress: processed={idx}/{len(to_fetch)} added_docs={added_docs} added_rows={added_rows} errors={errors}")
+            
+            prefetcher.close()
             
             # Guardar final
             checkpoint_save(force=True)
@@ -434,3 +508,18 @@ class EfaturaSupplierDocsDownloadApp(BaseApp):
                 success=False,
                 message=f"Erro inesperado: {str(e)}"
             )
+    
+    def cleanup(self, config: Dict[str, Any], context: AppContext) -> None:
+        """Cancela downloads pendentes e fecha as ligações HTTP (keep-alive) do cliente eFatura e do IdP."""
+        prefetcher = getattr(self, "_prefetcher", None)
+        if prefetcher is not None:
+            prefetcher.close()
+            self._prefetcher = None
+        client = getattr(self, "_client", None)
+        if client is not None:
+            client.close()
+            self._client = None
+        auth = getattr(self, "_auth", None)
+        if auth is not None:
+            auth.close()
+            self._auth = None
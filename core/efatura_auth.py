@@ -5,9 +5,11 @@ Gerenciamento de autenticação OIDC/OAuth2 para eFatura.
 from __future__ import annotations
 
 import base64
+import functools
 import hashlib
 import json
 import logging
+import os
 import secrets
 import time
 from dataclasses import dataclass
@@ -16,15 +18,29 @@ from typing import Any, Dict, Iterable, Optional, Tuple
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from core.exceptions import EfaturaAuthError, EfaturaAuthNeedsReauth
 
+try:  # opcional: (de)serialização JSON mais rápida do token store
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
 
 LOGGER = logging.getLogger(__name__)
 
 
 DEFAULT_MIN_TTL_SECONDS = 120
 DEFAULT_EXPIRES_SKEW_SECONDS = 30
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Campos que _normalize_tokens garante; um token store que já os tem (gravado por nós) não é recopiado
+_REQUIRED_FIELDS = frozenset({"expires_at", "obtained_at", "token_type", "issuer_url", "client_id", "redirect_uri"})
+
+# Validade da cópia em disco do OIDC discovery (configuração estática do IdP)
+DISCOVERY_CACHE_TTL_SECONDS = 24 * 3600
 
 
 @dataclass
@@ -54,21 +70,90 @@ class EfaturaAuthManager:
         self.retries = retries
         self.client_secret = client_secret
         self._discovery: Optional[OIDCDiscovery] = None
+        self._discovery_cache_path = token_store_path.parent / "oidc_discovery.json"
+        # último token store lido e normalizado, com a (mtime_ns, size) do ficheiro nessa leitura
+        self._tokens_cache: Optional[Tuple[Tuple[int, int], Dict[str, Any]]] = None
+        # último access token válido e o instante (time.monotonic) em que expira
+        self._cached: Optional[Tuple[str, float]] = None
+        # discovery, token e refresh vão ao mesmo IdP: uma Session reaproveita ligação e sessão TLS.
+        # As novas tentativas (erros de ligação e 429/5xx, com backoff exponencial) ficam a cargo do
+        # urllib3; `retries` continua a ser o nº total de tentativas.
+        retry = Retry(
+            total=max(0, int(retries) - 1),
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self) -> None:
+        """Fecha as ligações keep-alive ao IdP."""
+        self._session.close()
+
+    def invalidate(self) -> None:
+        """
+        Esquece o access token em memória (ex.: o servidor respondeu 401/403): a próxima chamada a
+        get_valid_access_token volta a ler o token store, que pode entretanto ter sido renovado.
+        """
+        self._cached = None
+        self._tokens_cache = None
 
     def discover(self) -> OIDCDiscovery:
         if self._discovery is not None:
             return self._discovery
-        url = f"{self.issuer_url}/.well-known/openid-configuration"
-        data = self._get_json_with_retries(url)
+        discovery = self._load_discovery_cache()
+        if discovery is None:
+            url = f"{self.issuer_url}/.well-known/openid-configuration"
+            data = self._get_json_with_retries(url)
+            try:
+                discovery = OIDCDiscovery(
+                    authorization_endpoint=str(data["authorization_endpoint"]),
+                    token_endpoint=str(data["token_endpoint"]),
+                )
+            except KeyError as exc:
+                raise EfaturaAuthError(f"OIDC discovery inválido: campo ausente {exc}") from exc
+            self._save_discovery_cache(discovery)
+        self._discovery = discovery
+        return discovery
+
+    def _load_discovery_cache(self) -> Optional[OIDCDiscovery]:
+        """Discovery guardado em disco por uma execução anterior (mesmo issuer, dentro do TTL)."""
+        path = self._discovery_cache_path
         try:
-            discovery = OIDCDiscovery(
+            if time.time() - path.stat().st_mtime >= DISCOVERY_CACHE_TTL_SECONDS:
+                return None
+            raw = path.read_bytes()
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            if data.get("issuer_url") != self.issuer_url:
+                return None
+            return OIDCDiscovery(
                 authorization_endpoint=str(data["authorization_endpoint"]),
                 token_endpoint=str(data["token_endpoint"]),
             )
-        except KeyError as exc:
-            raise EfaturaAuthError(f"OIDC discovery inválido: campo ausente {exc}") from exc
-        self._discovery = discovery
-        return discovery
+        except Exception:
+            return None
+
+    def _save_discovery_cache(self, discovery: OIDCDiscovery) -> None:
+        data = {
+            "issuer_url": self.issuer_url,
+            "authorization_endpoint": discovery.authorization_endpoint,
+            "token_endpoint": discovery.token_endpoint,
+        }
+        path = self._discovery_cache_path
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if orjson is not None:
+                tmp.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            else:
+                tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as exc:
+            LOGGER.warning("Não foi possível guardar o discovery OIDC em %s: %s", path, exc)
 
     def build_authorization_url(self) -> Tuple[str, str, str]:
         discovery = self.discover()
@@ -99,7 +184,7 @@ class EfaturaAuthManager:
             payload["client_secret"] = self.client_secret
         tokens = self._post_token_endpoint(discovery.token_endpoint, payload)
         normalized = self._normalize_tokens(tokens)
-        self.save_tokens(normalized)
+        self._write_tokens(normalized)
         return normalized
 
     def refresh_tokens(self, refresh_token: str) -> Dict[str, Any]:
@@ -113,10 +198,15 @@ class EfaturaAuthManager:
             payload["client_secret"] = self.client_secret
         tokens = self._post_token_endpoint(discovery.token_endpoint, payload)
         normalized = self._normalize_tokens(tokens, refresh_token_override=refresh_token)
-        self.save_tokens(normalized)
+        self._write_tokens(normalized)
         return normalized
 
     def get_valid_access_token(self, min_ttl_seconds: int = DEFAULT_MIN_TTL_SECONDS) -> str:
+        # caminho rápido: token já validado nesta instância e ainda longe de expirar
+        cached = self._cached
+        if cached is not None and (cached[1] - time.monotonic()) > min_ttl_seconds:
+            return cached[0]
+
         tokens = self.load_tokens()
         if not tokens:
             raise EfaturaAuthNeedsReauth("Sem tokens persistidos.")
@@ -134,6 +224,7 @@ class EfaturaAuthManager:
 
         now = int(time.time())
         if expires_at and (expires_at - now) > min_ttl_seconds:
+            self._remember_token(access_token, expires_at)
             return access_token
 
         refresh_token = tokens.get("refresh_token")
@@ -142,25 +233,64 @@ class EfaturaAuthManager:
 
         try:
             refreshed = self.refresh_tokens(refresh_token)
-            return str(refreshed["access_token"])
+            access_token = str(refreshed["access_token"])
+            self._remember_token(access_token, refreshed.get("expires_at"))
+            return access_token
         except EfaturaAuthNeedsReauth:
             raise
         except EfaturaAuthError as exc:
             self._clear_tokens()
             raise EfaturaAuthNeedsReauth("Refresh token inválido ou revogado.") from exc
 
+    def _remember_token(self, access_token: str, expires_at: Any) -> None:
+        """Guarda o token em memória, com expires_at (epoch) convertido para o relógio monotónico."""
+        try:
+            self._cached = (access_token, time.monotonic() + (float(expires_at) - time.time()))
+        except (TypeError, ValueError):
+            self._cached = None
+
     def load_tokens(self) -> Optional[Dict[str, Any]]:
-        if not self.token_store_path.exists():
+        try:
+            st = self.token_store_path.stat()
+        except OSError:
             return None
+        key = (st.st_mtime_ns, st.st_size)
+        # ficheiro inalterado desde a última leitura: reutiliza o resultado já normalizado
+        if self._tokens_cache is not None and self._tokens_cache[0] == key:
+            return dict(self._tokens_cache[1])
         data = self._load_token_file(self.token_store_path)
         if not data:
             return None
-        return self._normalize_tokens(data, persist=False)
+        normalized = self._normalize_tokens(data, persist=False)
+        self._tokens_cache = (key, normalized)
+        return dict(normalized)
 
     def save_tokens(self, data: Dict[str, Any]) -> None:
-        normalized = self._normalize_tokens(data)
-        self.token_store_path.parent.mkdir(parents=True, exist_ok=True)
-        self.token_store_path.write_text(json.dumps(normalized, ensure_ascii=False, indent=2), encoding="utf-8")
+        self._write_tokens(self._normalize_tokens(data))
+
+    def _write_tokens(self, normalized: Dict[str, Any]) -> None:
+        """
+        Grava tokens já normalizados (sem voltar a passar por _normalize_tokens).
+        
+        Escrita atómica (ficheiro temporário + os.replace), para que uma interrupção a meio não deixe
+        o token store corrompido; se o conteúdo serializado for igual ao do disco não escreve nada.
+        """
+        if orjson is not None:
+            data = orjson.dumps(normalized, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(normalized, ensure_ascii=False, indent=2).encode("utf-8")
+        path = self.token_store_path
+        try:
+            if path.read_bytes() == data:
+                return
+        except OSError:
+            pass
+        self._tokens_cache = None
+        self._cached = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
 
     def migrate_legacy_tokens(self, legacy_path: Path) -> bool:
         if self.token_store_path.exists():
@@ -170,8 +300,7 @@ class EfaturaAuthManager:
         data = self._load_token_file(legacy_path)
         if not data:
             return False
-        normalized = self._normalize_tokens(data)
-        self.save_tokens(normalized)
+        self.save_tokens(data)
         return True
 
     def start_login(self) -> Dict[str, str]:
@@ -193,14 +322,28 @@ class EfaturaAuthManager:
         refresh_token_override: Optional[str] = None,
         persist: bool = True,
     ) -> Dict[str, Any]:
+        if (
+            not refresh_token_override
+            and _REQUIRED_FIELDS.issubset(data)
+            and data["issuer_url"] == self.issuer_url
+            and data["client_id"] == self.client_id
+            and data["redirect_uri"] == self.redirect_uri
+            and ("scope" in data or not self.scopes)
+            and not (persist and "expires_in" in data)
+        ):
+            # já normalizado (ex.: lido do token store): nada a acrescentar
+            return data
+
         tokens = dict(data)
-        now = int(time.time())
+        # time.time() só quando é preciso (expires_in a converter ou obtained_at em falta)
+        now: Optional[int] = None
         if refresh_token_override:
             tokens["refresh_token"] = refresh_token_override
 
         if "expires_at" not in tokens:
             expires_in = tokens.get("expires_in")
             if expires_in is not None:
+                now = int(time.time())
                 try:
                     expires_at = now + int(expires_in) - DEFAULT_EXPIRES_SKEW_SECONDS
                     tokens["expires_at"] = expires_at
@@ -213,7 +356,8 @@ class EfaturaAuthManager:
             if exp:
                 tokens["expires_at"] = int(exp) - DEFAULT_EXPIRES_SKEW_SECONDS
 
-        tokens.setdefault("obtained_at", now)
+        if "obtained_at" not in tokens:
+            tokens["obtained_at"] = now if now is not None else int(time.time())
         tokens.setdefault("token_type", "bearer")
         if "scope" not in tokens and self.scopes:
             tokens["scope"] = " ".join(self.scopes)
@@ -226,33 +370,27 @@ class EfaturaAuthManager:
         return tokens
 
     def _post_token_endpoint(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        last_exc: Optional[Exception] = None
-        for attempt in range(1, self.retries + 1):
-            try:
-                response = requests.post(url, data=payload, timeout=self.timeout)
-                if response.status_code >= 400:
-                    raise EfaturaAuthError(self._format_token_error(response))
-                return response.json()
-            except requests.RequestException as exc:
-                last_exc = exc
-                LOGGER.warning("Erro ao chamar token endpoint (tentativa %s/%s): %s", attempt, self.retries, exc)
-        raise EfaturaAuthError(f"Falha ao chamar token endpoint: {last_exc}")
+        try:
+            response = self._session.post(url, data=payload, timeout=self.timeout)
+            if response.status_code >= 400:
+                raise EfaturaAuthError(self._format_token_error(response))
+            return _response_json(response)
+        except requests.RequestException as exc:
+            LOGGER.warning("Erro ao chamar token endpoint (%s tentativa(s)): %s", self.retries, exc)
+            raise EfaturaAuthError(f"Falha ao chamar token endpoint: {exc}") from exc
 
     def _get_json_with_retries(self, url: str) -> Dict[str, Any]:
-        last_exc: Optional[Exception] = None
-        for attempt in range(1, self.retries + 1):
-            try:
-                response = requests.get(url, timeout=self.timeout)
-                response.raise_for_status()
-                return response.json()
-            except requests.RequestException as exc:
-                last_exc = exc
-                LOGGER.warning("Erro ao chamar discovery (tentativa %s/%s): %s", attempt, self.retries, exc)
-        raise EfaturaAuthError(f"Falha ao obter discovery OIDC: {last_exc}")
+        try:
+            response = self._session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return _response_json(response)
+        except requests.RequestException as exc:
+            LOGGER.warning("Erro ao chamar discovery (%s tentativa(s)): %s", self.retries, exc)
+            raise EfaturaAuthError(f"Falha ao obter discovery OIDC: {exc}") from exc
 
     def _format_token_error(self, response: requests.Response) -> str:
         try:
-            payload = response.json()
+            payload = _response_json(response)
         except ValueError:
             payload = {}
         error = payload.get("error")
@@ -265,6 +403,8 @@ class EfaturaAuthManager:
         return f"Token endpoint retornou HTTP {response.status_code}"
 
     def _clear_tokens(self) -> None:
+        self._tokens_cache = None
+        self._cached = None
         try:
             if self.token_store_path.exists():
                 self.token_store_path.unlink()
@@ -273,7 +413,8 @@ class EfaturaAuthManager:
 
     def _load_token_file(self, path: Path) -> Optional[Dict[str, Any]]:
         try:
-            payload = json.loads(path.read_text(encoding="utf-8"))
+            raw = path.read_bytes()
+            payload = orjson.loads(raw) if orjson is not None else json.loads(raw)
         except Exception as exc:
             raise EfaturaAuthError(f"Falha ao ler tokens em {path}: {exc}") from exc
         if not isinstance(payload, dict):
@@ -284,28 +425,41 @@ class EfaturaAuthManager:
 
     @staticmethod
     def _generate_code_verifier() -> str:
-        verifier = secrets.token_urlsafe(96)
-        if len(verifier) < 43:
-            verifier = (verifier + secrets.token_urlsafe(64))[:96]
-        return verifier[:128]
+        # 96 bytes aleatórios -> exactamente 128 caracteres base64url (máximo do RFC 7636)
+        return secrets.token_urlsafe(96)
 
     @staticmethod
     def _build_code_challenge(code_verifier: str) -> str:
-        digest = hashlib.sha256(code_verifier.encode("utf-8")).digest()
-        return base64.urlsafe_b64encode(digest).decode("utf-8").rstrip("=")
+        # o verifier é base64url (ASCII puro): codificação ASCII directa
+        digest = hashlib.sha256(code_verifier.encode("ascii")).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def _response_json(response: requests.Response) -> Any:
+    """
+    JSON da resposta lido directamente dos bytes (o IdP responde em UTF-8), sem a detecção de
+    charset de response.json(). Um corpo que não seja UTF-8 válido volta a response.json().
+    """
+    try:
+        return orjson.loads(response.content) if orjson is not None else json.loads(response.content)
+    except ValueError:
+        return response.json()
 
 
+@functools.lru_cache(maxsize=4)
 def _decode_jwt_exp_unverified(token: Optional[str]) -> Optional[int]:
     if not token:
         return None
     try:
-        parts = token.split(".")
-        if len(parts) < 2:
+        # só o segmento do payload: header.payload.signature (a assinatura não é copiada)
+        i = token.find(".")
+        if i < 0:
             return None
-        payload_b64 = parts[1]
+        j = token.find(".", i + 1)
+        payload_b64 = token[i + 1:j] if j >= 0 else token[i + 1:]
         padding = "=" * (-len(payload_b64) % 4)
         payload = base64.urlsafe_b64decode(payload_b64 + padding)
-        obj = json.loads(payload.decode("utf-8", errors="replace"))
+        obj = json.loads(payload)
         exp = obj.get("exp")
         return int(exp) if exp is not None else None
     except Exception:
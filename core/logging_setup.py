@@ -3,10 +3,17 @@ Setup de logging comum para todas as mini apps.
 """
 
 import logging
+import logging.handlers
 import sys
 from pathlib import Path
 from typing import Optional
 
+# Formatter partilhado por todos os handlers (criado uma vez, reutilizado em cada setup_logging)
+_FMT = logging.Formatter(
+    "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
 
 def setup_logging(
     log_file: Optional[Path] = None,
@@ -28,25 +35,30 @@ def setup_logging(
     logger.setLevel(level)
     logger.propagate = False
     
-    # Remover handlers existentes (para evitar duplicação em re-runs)
+    # Remover handlers existentes (para evitar duplicação em re-runs); fechar escoa o buffer do ficheiro
+    for handler in logger.handlers:
+        target = getattr(handler, "target", None)
+        handler.close()
+        if target is not None:
+            target.close()
     logger.handlers = []
     
-    # Formato
-    fmt = logging.Formatter(
-        "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
-    
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(fmt)
+    console_handler.setFormatter(_FMT)
     logger.addHandler(console_handler)
     
-    # File handler (se especificado)
+    # File handler (se especificado), com buffer: os registos acumulam em memória e são escritos em
+    # bloco (512 registos, um ERROR ou o fim do processo) em vez de um write por linha
     if log_file:
         log_file.parent.mkdir(parents=True, exist_ok=True)
         file_handler = logging.FileHandler(str(log_file), encoding="utf-8")
-        file_handler.setFormatter(fmt)
-        logger.addHandler(file_handler)
+        file_handler.setFormatter(_FMT)
+        mem_handler = logging.handlers.MemoryHandler(
+            capacity=512,
+            flushLevel=logging.ERROR,
+            target=file_handler
+        )
+        logger.addHandler(mem_handler)
     
     return logger
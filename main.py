@@ -13,9 +13,20 @@ from orchestrator.runner import AppOrchestrator
 from core.logging_setup import setup_logging
 import logging
 
+try:  # opcional: parsing JSON mais rápido (fallback: json da stdlib)
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 
+def load_json_file(path: Path):
+    """Lê um ficheiro JSON (config/workflow) a partir dos bytes, com orjson quando disponível."""
+    raw = path.read_bytes()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="BWB App - Orquestrador de Mini Apps",
@@ -77,12 +88,12 @@ Exemplos:
     
     # Inicializar orquestrador
     base_dir = args.base_dir.resolve()
-    logger.info(f"BWB App iniciado. Base dir: {base_dir}")
+    logger.info("BWB App iniciado. Base dir: %s", base_dir)
     
     try:
         orchestrator = AppOrchestrator(base_dir)
     except Exception as e:
-        logger.error(f"Erro ao inicializar orquestrador: {e}", exc_info=True)
+        logger.error("Erro ao inicializar orquestrador: %s", e, exc_info=True)
         return 1
     
     # Listar apps se solicitado
@@ -102,26 +113,26 @@ Exemplos:
     config_data = {}
     if args.config:
         if not args.config.exists():
-            logger.error(f"Ficheiro de configuração não encontrado: {args.config}")
+            logger.error("Ficheiro de configuração não encontrado: %s", args.config)
             return 1
         try:
-            config_data = json.loads(args.config.read_text(encoding="utf-8"))
+            config_data = load_json_file(args.config)
         except Exception as e:
-            logger.error(f"Erro ao carregar configuração: {e}")
+            logger.error("Erro ao carregar configuração: %s", e)
             return 1
     
     # Executar workflow
     if args.workflow:
         if not args.workflow.exists():
-            logger.error(f"Ficheiro de workflow não encontrado: {args.workflow}")
+            logger.error("Ficheiro de workflow não encontrado: %s", args.workflow)
             return 1
         try:
-            workflow_config = json.loads(args.workflow.read_text(encoding="utf-8"))
+            workflow_config = load_json_file(args.workflow)
         except Exception as e:
-            logger.error(f"Erro ao carregar workflow: {e}")
+            logger.error("Erro ao carregar workflow: %s", e)
             return 1
         
-        logger.info(f"Executando workflow: {workflow_config.get('name', 'unnamed')}")
+        logger.info("Executando workflow: %s", workflow_config.get('name', 'unnamed'))
         results = orchestrator.run_workflow(workflow_config)
         
         # Resumo
@@ -165,5 +176,5 @@ if __name__ == "__main__":
         logger.info("Interrompido pelo utilizador.")
         sys.exit(130)
     except Exception as e:
-        logger.exception(f"Erro fatal: {e}")
+        logger.exception("Erro fatal: %s", e)
         sys.exit(1)
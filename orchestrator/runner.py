@@ -4,8 +4,10 @@ Orquestrador principal para executar mini apps.
 
 import importlib
 import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Tuple
 from core.base_app import BaseApp, AppResult
 from core.context import AppContext
 from core.logging_setup import setup_logging
@@ -36,15 +38,37 @@ class AppOrchestrator:
         else:
             self.context = context
         
+        # Apps já importadas (instâncias) e metadados de todas as apps registadas
         self.apps: Dict[str, BaseApp] = {}
+        self._app_specs: Dict[str, Dict[str, Any]] = {}
+        self._import_lock = threading.Lock()
+        # Resultados de dependências já executadas com sucesso, por (nome, config serializada).
+        # Só existe durante um run_workflow (ou um run_app de topo): uma dependência partilhada
+        # por várias apps corre uma única vez.
+        self._run_cache: Optional[Dict[Tuple[str, str], AppResult]] = None
+        # Com parallel, apps da mesma camada podem partilhar uma dependência fora do workflow:
+        # _cache_lock protege _run_cache e _in_flight guarda a execução em curso de cada chave,
+        # para que as outras threads esperem pelo resultado em vez de a executarem outra vez.
+        self._cache_lock = threading.Lock()
+        self._in_flight: Dict[Tuple[str, str], Tuple[Future, int]] = {}  # chave -> (Future, thread dona)
+        self._waiting: Dict[int, Tuple[str, str]] = {}  # thread -> chave por que espera
+        # Chaves em resolução na thread actual (deteção de ciclos de dependências)
+        self._resolving = threading.local()
         self._load_apps()
     
     def _load_apps(self):
-        """Carrega dinamicamente todas as mini apps."""
+        """
+        Regista as mini apps de apps/.
+        
+        Apps com manifest.json (name, description, version, dependencies) ficam só registadas: o
+        módulo app.py é importado na primeira execução (_get_app), o que evita importar todas as apps
+        (e as suas dependências) em --list-apps ou ao correr uma única app. Sem manifest, a app é
+        importada já, como antes.
+        """
         apps_dir = self.base_dir / "apps"
         
         if not apps_dir.exists():
-            logger.warning(f"Diretório apps não encontrado: {apps_dir}")
+            logger.warning("Diretório apps não encontrado: %s", apps_dir)
             return
         
         for app_dir in apps_dir.iterdir():
@@ -58,40 +82,100 @@ class AppOrchestrator:
             if not init_file.exists() or not app_file.exists():
                 continue
             
-            try:
-                # Importar módulo
-                module_name = f"apps.{app_dir.name}.app"
-                module = importlib.import_module(module_name)
-                
-                # Procurar classe App ou classe que herda de BaseApp
-                app_class = None
-                for attr_name in dir(module):
-                    attr = getattr(module, attr_name)
-                    if (isinstance(attr, type) and 
-                        issubclass(attr, BaseApp) and 
-                        attr is not BaseApp):
-                        app_class = attr
-                        break
-                
-                if app_class:
-                    app_instance = app_class()
-                    self.apps[app_instance.name] = app_instance
-                    logger.info(f"Mini app carregada: {app_instance.name} v{app_instance.version}")
-                else:
-                    logger.warning(f"Nenhuma classe BaseApp encontrada em {module_name}")
-                    
-            except Exception as e:
-                logger.error(f"Erro ao carregar app {app_dir.name}: {e}", exc_info=True)
+            module_name = f"apps.{app_dir.name}.app"
+            manifest = self._read_manifest(app_dir / "manifest.json")
+            if manifest is not None:
+                manifest["module"] = module_name
+                self._app_specs[manifest["name"]] = manifest
+                logger.debug("Mini app registada: %s v%s", manifest['name'], manifest['version'])
+                continue
+            
+            app_instance = self._import_app(module_name)
+            if app_instance is not None:
+                self._app_specs[app_instance.name] = {
+                    "name": app_instance.name,
+                    "description": app_instance.description,
+                    "version": app_instance.version,
+                    "dependencies": app_instance.get_dependencies(),
+                    "module": module_name,
+                }
+                self.apps[app_instance.name] = app_instance
+    
+    @staticmethod
+    def _read_manifest(path: Path) -> Optional[Dict[str, Any]]:
+        """Lê o manifest.json de uma app; None se não existir ou estiver incompleto."""
+        if not path.exists():
+            return None
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            return {
+                "name": str(data["name"]),
+                "description": str(data.get("description", "")),
+                "version": str(data.get("version", "")),
+                "dependencies": [str(d) for d in data.get("dependencies", [])],
+            }
+        except Exception as e:
+            logger.warning("Manifest inválido em %s: %s; a app será importada", path, e)
+            return None
+    
+    def _import_app(self, module_name: str) -> Optional[BaseApp]:
+        """Importa o módulo de uma app e instancia a sua classe BaseApp."""
+        try:
+            # Importar módulo
+            module = importlib.import_module(module_name)
+            
+            # Procurar classe App ou classe que herda de BaseApp
+            app_class = None
+            for attr_name in dir(module):
+                attr = getattr(module, attr_name)
+                if (isinstance(attr, type) and 
+                    issubclass(attr, BaseApp) and 
+                    attr is not BaseApp):
+                    app_class = attr
+                    break
+            
+            if app_class:
+                app_instance = app_class()
+                logger.info("Mini app carregada: %s v%s", app_instance.name, app_instance.version)
+                return app_instance
+            logger.warning("Nenhuma classe BaseApp encontrada em %s", module_name)
+        except Exception as e:
+            logger.error("Erro ao carregar app %s: %s", module_name, e, exc_info=True)
+        return None
+    
+    def _get_app(self, app_name: str) -> Optional[BaseApp]:
+        """Instância da app, importando o módulo na primeira utilização."""
+        app = self.apps.get(app_name)
+        if app is not None:
+            return app
+        spec = self._app_specs.get(app_name)
+        if spec is None:
+            return None
+        with self._import_lock:
+            app = self.apps.get(app_name)
+            if app is None:
+                app = self._import_app(spec["module"])
+                if app is None:
+                    return None
+                if app.name != app_name:
+                    logger.warning("manifest.json de '%s' não corresponde à app '%s'", app_name, app.name)
+                self.apps[app_name] = app
+        return app
+    
+    @staticmethod
+    def _cache_key(app_name: str, config: Dict[str, Any]) -> Tuple[str, str]:
+        """Chave de _run_cache: nome da app + config serializada de forma estável."""
+        return app_name, json.dumps(config, sort_keys=True, default=str)
     
     def list_apps(self) -> Dict[str, Dict[str, str]]:
-        """Lista todas as mini apps disponíveis."""
+        """Lista todas as mini apps disponíveis (a partir dos metadados, sem importar as apps)."""
         return {
             name: {
-                "description": app.description,
-                "version": app.version,
-                "dependencies": app.get_dependencies()
+                "description": spec["description"],
+                "version": spec["version"],
+                "dependencies": list(spec["dependencies"])
             }
-            for name, app in self.apps.items()
+            for name, spec in self._app_specs.items()
         }
     
     def run_app(
@@ -111,13 +195,18 @@ class AppOrchestrator:
         Returns:
             AppResult com resultado da execução
         """
-        if app_name not in self.apps:
+        if app_name not in self._app_specs:
             return AppResult(
                 success=False,
-                message=f"App '{app_name}' não encontrada. Apps disponíveis: {', '.join(self.apps.keys())}"
+                message=f"App '{app_name}' não encontrada. Apps disponíveis: {', '.join(self._app_specs.keys())}"
             )
         
-        app = self.apps[app_name]
+        app = self._get_app(app_name)
+        if app is None:
+            return AppResult(
+                success=False,
+                message=f"Erro ao carregar a app '{app_name}'"
+            )
         
         # Validar configuração
         is_valid, error = app.validate_config(config)
@@ -130,30 +219,36 @@ class AppOrchestrator:
         # Resolver dependências
         if run_dependencies:
             deps = app.get_dependencies()
-            for dep_name in deps:
-                logger.info(f"Executando dependência '{dep_name}' para '{app_name}'...")
-                dep_config = config.get("dependencies", {}).get(dep_name, {})
-                dep_result = self.run_app(dep_name, dep_config, run_dependencies=True)
-                if not dep_result.success:
-                    return AppResult(
-                        success=False,
-                        message=f"Dependência '{dep_name}' falhou: {dep_result.message}"
-                    )
+            owns_cache = self._run_cache is None
+            if owns_cache:
+                self._run_cache = {}
+            try:
+                for dep_name in deps:
+                    dep_config = config.get("dependencies", {}).get(dep_name, {})
+                    dep_result = self._run_dependency(app_name, dep_name, dep_config)
+                    if not dep_result.success:
+                        return AppResult(
+                            success=False,
+                            message=f"Dependência '{dep_name}' falhou: {dep_result.message}"
+                        )
+            finally:
+                if owns_cache:
+                    self._run_cache = None
         
         # Executar app
         try:
-            logger.info(f"Executando mini app: {app_name}")
+            logger.info("Executando mini app: %s", app_name)
             result = app.run(config, self.context)
             
             if result.success:
-                logger.info(f"Mini app '{app_name}' executada com sucesso: {result.message}")
+                logger.info("Mini app '%s' executada com sucesso: %s", app_name, result.message)
             else:
-                logger.error(f"Mini app '{app_name}' falhou: {result.message}")
+                logger.error("Mini app '%s' falhou: %s", app_name, result.message)
             
             return result
             
         except Exception as e:
-            logger.exception(f"Erro ao executar '{app_name}': {e}")
+            logger.exception("Erro ao executar '%s': %s", app_name, e)
             return AppResult(
                 success=False,
                 message=f"Erro inesperado: {str(e)}"
@@ -163,7 +258,79 @@ class AppOrchestrator:
             try:
                 app.cleanup(config, self.context)
             except Exception as e:
-                logger.warning(f"Erro no cleanup de '{app_name}': {e}")
+                logger.warning("Erro no cleanup de '%s': %s", app_name, e)
+    
+    def _run_dependency(self, app_name: str, dep_name: str, dep_config: Dict[str, Any]) -> AppResult:
+        """
+        Executa a dependência dep_name de app_name, ou reutiliza o resultado de _run_cache.
+        Se outra thread já a estiver a executar com a mesma config, espera por esse resultado.
+        """
+        key = self._cache_key(dep_name, dep_config)
+        stack: Optional[List[Tuple[str, str]]] = getattr(self._resolving, "keys", None)
+        if stack is None:
+            stack = self._resolving.keys = []
+        if key in stack:
+            cycle = [k[0] for k in stack[stack.index(key):]] + [dep_name]
+            return self._cycle_result(" -> ".join(cycle))
+        
+        me = threading.get_ident()
+        with self._cache_lock:
+            dep_result = self._run_cache.get(key)
+            in_flight = self._in_flight.get(key) if dep_result is None else None
+            owner = dep_result is None and in_flight is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = (future, me)
+            elif in_flight is not None:
+                future = in_flight[0]
+                if self._waits_on(in_flight[1], me):
+                    # a thread dona espera (directa ou indirectamente) por uma chave desta thread
+                    return self._cycle_result(dep_name)
+                self._waiting[me] = key
+        
+        if dep_result is not None:
+            logger.info("Dependência '%s' já executada neste workflow; reutilizando resultado.", dep_name)
+            return dep_result
+        if not owner:
+            logger.info("Dependência '%s' já em execução noutra thread; aguardando resultado.", dep_name)
+            try:
+                return future.result()
+            finally:
+                with self._cache_lock:
+                    del self._waiting[me]
+        
+        dep_result = AppResult(success=False, message="Execução interrompida")
+        stack.append(key)
+        try:
+            logger.info("Executando dependência '%s' para '%s'...", dep_name, app_name)
+            dep_result = self.run_app(dep_name, dep_config, run_dependencies=True)
+            return dep_result
+        finally:
+            stack.pop()
+            with self._cache_lock:
+                if dep_result.success:
+                    self._run_cache[key] = dep_result
+                del self._in_flight[key]
+            future.set_result(dep_result)
+    
+    def _waits_on(self, thread_id: int, target: int) -> bool:
+        """True se thread_id espera, directa ou indirectamente, por uma chave de target (com _cache_lock)."""
+        seen: Set[int] = set()
+        while thread_id not in seen:
+            if thread_id == target:
+                return True
+            seen.add(thread_id)
+            key = self._waiting.get(thread_id)
+            in_flight = self._in_flight.get(key) if key is not None else None
+            if in_flight is None:
+                return False
+            thread_id = in_flight[1]
+        return False
+    
+    @staticmethod
+    def _cycle_result(cycle: str) -> AppResult:
+        logger.error("Ciclo de dependências: %s", cycle)
+        return AppResult(success=False, message=f"Ciclo de dependências: {cycle}")
     
     def run_workflow(self, workflow_config: Dict[str, Any]) -> List[AppResult]:
         """
@@ -174,6 +341,8 @@ class AppOrchestrator:
                 {
                     "name": "nome_workflow",
                     "continue_on_error": False,
+                    "parallel": False,  # opcional: apps independentes correm em simultâneo
+                    "max_workers": 4,  # opcional, só com parallel
                     "apps": [
                         {"name": "app1", "config": {...}},
                         {"name": "app2", "config": {...}}
@@ -183,28 +352,127 @@ class AppOrchestrator:
         Returns:
             Lista de resultados de cada app
         """
-        results = []
         apps_to_run = workflow_config.get("apps", [])
         continue_on_error = workflow_config.get("continue_on_error", False)
         
-        logger.info(f"Iniciando workflow: {workflow_config.get('name', 'unnamed')}")
+        logger.info("Iniciando workflow: %s", workflow_config.get('name', 'unnamed'))
+        
+        self._run_cache = {}
+        try:
+            if workflow_config.get("parallel", False):
+                results = self._run_workflow_layers(
+                    apps_to_run, continue_on_error, workflow_config.get("max_workers")
+                )
+            else:
+                results = self._run_workflow_apps(apps_to_run, continue_on_error)
+        finally:
+            self._run_cache = None
         
+        logger.info("Workflow concluído. %s/%s apps bem-sucedidas", sum(1 for r in results if r.success), len(results))
+        return results
+    
+    def _run_workflow_apps(self, apps_to_run: List[Dict[str, Any]], continue_on_error: bool) -> List[AppResult]:
+        """Executa as apps do workflow em sequência."""
+        results = []
         for idx, app_config in enumerate(apps_to_run, start=1):
             app_name = app_config.get("name")
             if not app_name:
-                logger.warning(f"App #{idx} sem nome, ignorando...")
+                logger.warning("App #%s sem nome, ignorando...", idx)
                 continue
             
             config = app_config.get("config", {})
-            logger.info(f"[{idx}/{len(apps_to_run)}] Executando: {app_name}")
+            logger.info("[%s/%s] Executando: %s", idx, len(apps_to_run), app_name)
             
             result = self.run_app(app_name, config)
             results.append(result)
+            if result.success:
+                # uma app seguinte que dependa desta (com a mesma config) não a volta a executar
+                self._run_cache[self._cache_key(app_name, config)] = result
             
             # Se uma app falhar e workflow não permitir continuar
             if not result.success and not continue_on_error:
-                logger.error(f"Workflow interrompido devido a falha em '{app_name}'")
+                logger.error("Workflow interrompido devido a falha em '%s'", app_name)
                 break
-        
-        logger.info(f"Workflow concluído. {sum(1 for r in results if r.success)}/{len(results)} apps bem-sucedidas")
         return results
+    
+    def _workflow_dependencies(self, app_name: str, names: Set[str]) -> Set[str]:
+        """Apps do workflow (em names) das quais app_name depende, directa ou indirectamente."""
+        found: Set[str] = set()
+        stack = [app_name]
+        seen = {app_name}
+        while stack:
+            spec = self._app_specs.get(stack.pop())
+            if spec is None:
+                continue
+            for dep in spec["dependencies"]:
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                stack.append(dep)
+                if dep in names:
+                    found.add(dep)
+        return found
+    
+    def _run_workflow_layers(
+        self,
+        apps_to_run: List[Dict[str, Any]],
+        continue_on_error: bool,
+        max_workers: Optional[int] = None
+    ) -> List[AppResult]:
+        """
+        Executa as apps do workflow por camadas topológicas (get_dependencies): as apps de uma
+        camada não dependem umas das outras e correm em simultâneo numa ThreadPoolExecutor.
+        Os resultados mantêm a ordem do workflow.
+        """
+        entries = []
+        for idx, app_config in enumerate(apps_to_run, start=1):
+            app_name = app_config.get("name")
+            if not app_name:
+                logger.warning("App #%s sem nome, ignorando...", idx)
+                continue
+            entries.append((idx, app_name, app_config.get("config", {})))
+        
+        names = {name for _, name, _ in entries}
+        deps = {name: self._workflow_dependencies(name, names) for name in names}
+        total = len(apps_to_run)
+        
+        def run_entry(entry) -> AppResult:
+            idx, app_name, config = entry
+            logger.info("[%s/%s] Executando: %s", idx, total, app_name)
+            result = self.run_app(app_name, config)
+            if result.success:
+                with self._cache_lock:
+                    self._run_cache[self._cache_key(app_name, config)] = result
+            return result
+        
+        results: Dict[int, AppResult] = {}
+        pending = entries
+        while pending:
+            waiting = {name for _, name, _ in pending}
+            # a mesma app duas vezes não corre em simultâneo (a instância BaseApp é partilhada e
+            # guarda estado da execução): só a primeira ocorrência entra na camada
+            layer, layer_names = [], set()
+            for e in pending:
+                if e[1] not in layer_names and not (deps[e[1]] & waiting):
+                    layer.append(e)
+                layer_names.add(e[1])
+            if not layer:
+                # dependência circular: a próxima app pela ordem do workflow corre sozinha, como no
+                # modo sequencial; as restantes voltam a ser agrupadas na iteração seguinte
+                layer = pending[:1]
+            pending = [e for e in pending if e not in layer]
+            
+            if len(layer) == 1:
+                layer_results = [run_entry(layer[0])]
+            else:
+                workers = min(len(layer), max(1, int(max_workers or len(layer))))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="workflow") as pool:
+                    layer_results = list(pool.map(run_entry, layer))
+            
+            failed = [e[1] for e, r in zip(layer, layer_results) if not r.success]
+            results.update((e[0], r) for e, r in zip(layer, layer_results))
+            if failed and not continue_on_error:
+                logger.error("Workflow interrompido devido a falha em %s", ', '.join(repr(n) for n in failed))
+                break
+        
+        return [results[idx] for idx in sorted(results)]